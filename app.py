@@ -1,20 +1,28 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
-from pydantic import BaseModel
-from typing import Dict, Any
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, StringConstraints
+from typing import Annotated, Dict, Any, Optional
 import os
-from datetime import datetime
-from services.config import create_rotating_log, log_config
+import re
+import secrets
+import time
+import orjson
+from services.config import create_rotating_log, log_config, vector_config
 
 # Importar el pipeline CUPRA
-from services.llm.cupra_rag_pipeline import CupraRAGPipeline
-from services.llm.cupra_retrieval import cupra_retriever
+from services.llm.cupra_rag_pipeline import CupraRAGPipeline, cargar_tokenizador
+from services.llm.cupra_retrieval import get_retriever
+from services.semantic_cache import semantic_cache
+from services.embed_batcher import embed_batcher
+from services.retrieval_cache import retrieval_cache
 
 app = FastAPI(
     title="CUPRA Assistant API",
     description="API para asistencia inteligente de vehículos CUPRA",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Montar archivos estáticos correctamente
@@ -32,8 +40,7 @@ def initialize():
     
     if guardar_log:
         # Crear directorio de logs si no existe
-        if not os.path.exists(log_config.logs_folder):
-            os.makedirs(log_config.logs_folder)
+        os.makedirs(log_config.logs_folder, exist_ok=True)
     
     # Inicializar logger
     nombreLog = os.path.splitext(os.path.basename(__file__))[0]  # "main"
@@ -52,15 +59,38 @@ def initialize():
 logger = initialize()
 #-----------------------------------------------------------------------------------------------------
 
-# Inicializar pipeline
+# Pipeline: se crea en startup_event, dentro de cada worker (no al importar,
+# para que el proceso supervisor de uvicorn no abra conexiones que no usa)
 pipeline = None
 
-try:
-    pipeline = CupraRAGPipeline(logger=logger)
-    # logger.info(" CUPRA RAG Pipeline inicializado correctamente")
-except Exception as e:
-    logger.warning(f"❌ Error inicializando pipeline: {e}")
-    pipeline = None
+# Workers de uvicorn (WEB_CONCURRENCY es también el valor por defecto de --workers)
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+# Conexiones a PostgreSQL para toda la instancia, repartidas entre los workers
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 20))
+DB_POOL_MAX = max(2, DB_MAX_CONNECTIONS // WORKERS)
+DB_POOL_MIN = min(2, DB_POOL_MAX)
+
+# Cursor de paginación por título: "<num>:<chunk_id>" (solo dígitos ASCII)
+CURSOR_TITULO = re.compile(r"(-?[0-9]+):([0-9]+)")
+
+def _iniciar_pipeline() -> Optional[CupraRAGPipeline]:
+    """Crea el pool del worker y después el pipeline (que ya consulta la base de datos)"""
+    try:
+        get_retriever().iniciar_pool(minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX)
+        return CupraRAGPipeline(logger=logger)
+    except Exception as e:
+        logger.warning(f"❌ Error inicializando pipeline: {e}")
+        return None
+
+# Timestamp "%Y-%m-%d %H:%M:%S" formateado como mucho una vez por segundo
+_now_cache = [0, ""]
+
+def _now_str() -> str:
+    segundo = int(time.time())
+    if segundo != _now_cache[0]:
+        _now_cache[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(segundo))
+        _now_cache[0] = segundo
+    return _now_cache[1]
 
 # Modelos Pydantic
 class ChatRequest(BaseModel):
@@ -73,29 +103,66 @@ class ChatResponse(BaseModel):
     evaluacion_calidad: str
     chunks_recuperados: int
     timestamp: str
+    # Identificador para consultar la evaluación de calidad (/api/chat/quality/{request_id})
+    request_id: str = ""
     fuente: str
 
+class TitleSearchRequest(BaseModel):
+    # Mínimo 3 caracteres para no convertir el ILIKE en un barrido de toda la tabla
+    titulo: Annotated[str, StringConstraints(strip_whitespace=True, min_length=3)]
+    limit: int = Field(10, ge=1, le=100)
+    # next_cursor devuelto por la página anterior ("<num>:<chunk_id>")
+    cursor: Optional[str] = None
+
 class HealthResponse(BaseModel):
     status: str
     pipeline_available: bool
     database_status: Dict[str, Any]
     timestamp: str
 
+# Respuestas estáticas precalculadas una sola vez al importar
+def _cargar_html(path: str):
+    """Lee una plantilla HTML como bytes (None si no existe)"""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+# _INDEX_HTML = _cargar_html("chatbot.html")
+# _INDEX_HTML = _cargar_html("templates/SS_SS.html")
+_INDEX_HTML = _cargar_html("templates/Ss.html")
+
+_EJEMPLOS = [
+    "¿Cómo funciona el sistema de luces del CUPRA?",
+    "¿Qué tipos de airbags tiene el vehículo?",
+    "¿Cómo se usa la climatización?",
+    "¿Cuáles son las características de la cámara frontal?",
+    "¿Cómo configurar el sistema de navegación?",
+    "¿Qué sistemas de seguridad incluye el vehículo?",
+    "¿Cómo funciona el sistema de frenado?",
+    "¿Cuáles son las características del motor?",
+    "¿Cómo se ajustan los asientos?",
+    "¿Qué hacer si aparece una luz de advertencia?"
+]
+
+_EXAMPLES_RESPONSE = orjson.dumps({
+    "success": True,
+    "ejemplos": _EJEMPLOS,
+    "total": len(_EJEMPLOS)
+})
+
 # Rutas
 @app.get("/", response_class=HTMLResponse)
 async def chatbot_interface():
     """Servir la interfaz del chatbot"""
-    try:
-        # with open("chatbot.html", "r", encoding="utf-8") as f:
-        # with open("templates/SS_SS.html", "r", encoding="utf-8") as f:
-        with open("templates/Ss.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
+    if _INDEX_HTML is None:
         logger.error(" .html no encontrado")
         return HTMLResponse(
             content="<h1>Error: chatbot.html no encontrado</h1>",
             status_code=404
         )
+    return HTMLResponse(content=_INDEX_HTML)
 
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
@@ -108,27 +175,10 @@ async def chat_endpoint(request: ChatRequest):
     Returns:
         Respuesta completa del pipeline RAG
     """
-    try:
-        # Verificar que el pipeline esté disponible
-        # if pipeline is None:
-        #     raise HTTPException(
-        #         status_code=500, 
-        #         detail="Pipeline no disponible - Error en la inicialización del sistema"
-        #     )
-        if pipeline is None:
-            return JSONResponse(
-                status_code=503,
-                content={
-                    "success": False,
-                    "query": request.query,
-                    "respuesta_llm": {"respuesta": "Servicio en modo degradado (DB no disponible).", "confianza": 0.0, "fuentes": []},
-                    "evaluacion_calidad": "5",
-                    "chunks_recuperados": 0,
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "fuente": "PostgreSQL"
-                }
-            )
+    # startup_event aborta el arranque si el pipeline no está disponible
+    assert pipeline is not None
 
+    try:
         # Validar consulta
         query = request.query.strip()
         if not query:
@@ -139,11 +189,31 @@ async def chat_endpoint(request: ChatRequest):
 
         logger.info(f" Nueva consulta recibida: {query}")
 
-        # Procesar consulta usando el pipeline completo
-        resultado = pipeline.procesar_consulta_completa(query)
+        # Consultar el cache semántico antes de lanzar el pipeline
+        query_embedding = await embed_batcher.embed(query)
+        respuesta_cacheada = semantic_cache.lookup(query_embedding) if query_embedding else None
+        if respuesta_cacheada is not None:
+            logger.info("Consulta servida desde el cache semántico")
+            # Se conserva el request_id original: su evaluación es la de la respuesta cacheada
+            return respuesta_cacheada.model_copy(update={
+                'query': query,
+                'timestamp': _now_str()
+            })
+
+        # La evaluación en segundo plano se copia a la respuesta ya cacheada,
+        # para que los aciertos del cache semántico también la lleven
+        respuestas_a_evaluar = []
+        def al_evaluar(evaluacion: str):
+            for r in respuestas_a_evaluar:
+                r.evaluacion_calidad = evaluacion
+        
+        # Procesar consulta usando el pipeline completo (asíncrono)
+        resultado = await pipeline.procesar_consulta_completa_async(
+            query, query_embedding or None, on_evaluacion=al_evaluar
+        )
         
-        # Preparar respuesta
-        respuesta = ChatResponse(
+        # Preparar respuesta (los datos vienen del pipeline: sin revalidar)
+        respuesta = ChatResponse.model_construct(
             success=True,
             query=query,
             respuesta_llm={
@@ -154,12 +224,21 @@ async def chat_endpoint(request: ChatRequest):
             evaluacion_calidad=resultado['evaluacion_calidad'],
             chunks_recuperados=len(resultado['chunks_recuperados']),
             timestamp=resultado['timestamp'],
+            request_id=resultado['request_id'],
             fuente='PostgreSQL'
         )
+        # Sin await desde procesar_consulta_completa_async: la evaluación aún no
+        # ha podido terminar, al_evaluar la aplicará sobre esta respuesta
+        respuestas_a_evaluar.append(respuesta)
         
         # print(f"✅ Consulta procesada exitosamente - Confianza: {resultado['respuesta_llm']['confianza']:.2f}")
         logger.info(f"Consulta procesada exitosamente - Confianza: {resultado['respuesta_llm']['confianza']:.2f}")
         
+        # Solo se cachean respuestas fundamentadas en el manual (nunca los fallos del LLM)
+        if (query_embedding and resultado['chunks_recuperados']
+                and not resultado['respuesta_llm'].get('error')):
+            semantic_cache.store(query_embedding, respuesta)
+        
         return respuesta
 
     except HTTPException:
@@ -172,6 +251,62 @@ async def chat_endpoint(request: ChatRequest):
             detail=f"Error interno procesando la consulta: {str(e)}"
         )
 
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Endpoint de chat en streaming (Server-Sent Events)
+    
+    Emite `meta` con los chunks recuperados, `token` con cada fragmento de la
+    respuesta del LLM según se genera y `done` con la evaluación de calidad.
+    
+    Args:
+        request: Objeto con la consulta del usuario
+        
+    Returns:
+        Flujo text/event-stream
+    """
+    assert pipeline is not None
+
+    query = request.query.strip()
+    if not query:
+        raise HTTPException(
+            status_code=400, 
+            detail="La consulta no puede estar vacía"
+        )
+
+    logger.info(f" Nueva consulta (stream) recibida: {query}")
+    query_embedding = await embed_batcher.embed(query)
+
+    # El generador es asíncrono: Starlette lo itera en el event loop
+    return StreamingResponse(
+        pipeline.procesar_consulta_stream(query, query_embedding or None),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/chat/quality/{request_id}")
+async def chat_quality(request_id: str):
+    """
+    Endpoint para consultar la evaluación de calidad calculada en segundo plano
+    
+    Las evaluaciones se guardan en memoria del worker que generó la respuesta
+    (con WEB_CONCURRENCY > 1 otra instancia responderá como pendiente).
+    
+    Args:
+        request_id: request_id devuelto por /api/chat
+        
+    Returns:
+        Puntuación de calidad o pendiente si el Quality Agent no ha terminado
+    """
+    assert pipeline is not None
+
+    evaluacion = pipeline.obtener_evaluacion(request_id)
+    return {
+        "success": True,
+        "pendiente": evaluacion is None,
+        "evaluacion_calidad": evaluacion or ""
+    }
+
 @app.get("/api/health", response_model=HealthResponse)
 async def health_check():
     """
@@ -182,24 +317,16 @@ async def health_check():
     """
     try:
         # Verificar estado de la base de datos
-        salud_bd = cupra_retriever.verificar_salud_bd() if cupra_retriever else {
-        "pgvector_instalado": False,
-        "tabla_existe": False,
-        "indice_vectorial": False,
-        "conexion_ok": False,
-        "error": "Retriever no disponible al arranque"
-        }
-        
-        # salud_bd = cupra_retriever.verificar_salud_bd()
+        salud_bd = await run_in_threadpool(get_retriever().verificar_salud_bd)
         
         # Determinar estado general
         status = "ok" if pipeline is not None and salud_bd['conexion_ok'] else "error"
         
-        return HealthResponse(
+        return HealthResponse.model_construct(
             status=status,
             pipeline_available=pipeline is not None,
             database_status=salud_bd,
-            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            timestamp=_now_str()
         )
         
     except Exception as e:
@@ -219,14 +346,14 @@ async def database_stats():
         Estadísticas detalladas de la base de datos
     """
     try:
-        stats = cupra_retriever.obtener_estadisticas_bd()
-        salud = cupra_retriever.verificar_salud_bd()
+        stats = await run_in_threadpool(get_retriever().obtener_estadisticas_bd, logger)
+        salud = await run_in_threadpool(get_retriever().verificar_salud_bd)
         
         return {
             "success": True,
             "statistics": stats,
             "health": salud,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "timestamp": _now_str()
         }
         
     except Exception as e:
@@ -238,37 +365,48 @@ async def database_stats():
         )
 
 @app.post("/api/search/title")
-async def search_by_title(titulo: str, limit: int = 10):
+async def search_by_title(params: Annotated[TitleSearchRequest, Query()]):
     """
     Endpoint para buscar chunks por título específico
     
     Args:
-        titulo: Texto a buscar en títulos
-        limit: Número máximo de resultados
+        params: titulo (texto a buscar, mínimo 3 caracteres), limit (1-100)
+            y cursor (next_cursor de la página anterior, opcional)
         
     Returns:
-        Lista de chunks que coinciden con el título
+        Lista de chunks que coinciden con el título y el cursor de la página siguiente
     """
-    try:
-        if not titulo.strip():
+    despues_de = None
+    if params.cursor:
+        coincidencia = CURSOR_TITULO.fullmatch(params.cursor)
+        if coincidencia is None:
             raise HTTPException(
-                status_code=400, 
-                detail="El título no puede estar vacío"
+                status_code=400,
+                detail="Cursor de paginación no válido"
             )
+        despues_de = (int(coincidencia.group(1)), int(coincidencia.group(2)))
 
+    try:
         # Buscar por título
-        resultados = cupra_retriever.buscar_por_titulo(titulo.strip(), limit)
+        resultados = await run_in_threadpool(
+            get_retriever().buscar_por_titulo, params.titulo, params.limit, despues_de
+        )
+        
+        # Solo hay página siguiente si esta vino completa
+        next_cursor = None
+        if len(resultados) == params.limit:
+            ultimo = resultados[-1]
+            next_cursor = f"{ultimo['num']}:{ultimo['chunk_id']}"
         
         return {
             "success": True,
-            "titulo_buscado": titulo,
+            "titulo_buscado": params.titulo,
             "resultados": resultados,
             "total_encontrados": len(resultados),
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "next_cursor": next_cursor,
+            "timestamp": _now_str()
         }
         
-    except HTTPException:
-        raise
     except Exception as e:
         # print(f"❌ Error en búsqueda por título: {e}")
         logger.warning(f"❌ Error en búsqueda por título: {e}")
@@ -285,29 +423,51 @@ async def get_examples():
     Returns:
         Lista de consultas de ejemplo
     """
-    ejemplos = [
-        "¿Cómo funciona el sistema de luces del CUPRA?",
-        "¿Qué tipos de airbags tiene el vehículo?",
-        "¿Cómo se usa la climatización?",
-        "¿Cuáles son las características de la cámara frontal?",
-        "¿Cómo configurar el sistema de navegación?",
-        "¿Qué sistemas de seguridad incluye el vehículo?",
-        "¿Cómo funciona el sistema de frenado?",
-        "¿Cuáles son las características del motor?",
-        "¿Cómo se ajustan los asientos?",
-        "¿Qué hacer si aparece una luz de advertencia?"
-    ]
+    return Response(
+        content=_EXAMPLES_RESPONSE,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=3600"}
+    )
+
+# Token de los endpoints de administración (sin él quedan deshabilitados)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+@app.post("/api/admin/cache/clear")
+async def clear_caches(x_admin_token: Annotated[Optional[str], Header()] = None):
+    """
+    Endpoint para invalidar los caches (usar tras actualizar los chunks)
+    
+    Los caches viven en la memoria de cada worker: con WEB_CONCURRENCY > 1 esta
+    llamada solo vacía los del worker que la atiende (ver `pid` en la
+    respuesta). Para invalidar todos, reiniciar el servicio.
+    
+    Requiere la cabecera X-Admin-Token con el valor de ADMIN_TOKEN.
+    
+    Returns:
+        Número de entradas eliminadas de cada cache
+    """
+    if not ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    eliminadas = {
+        "semantic_cache": len(semantic_cache),
+        "retrieval_cache": len(retrieval_cache)
+    }
+    semantic_cache.clear()
+    retrieval_cache.clear()
+    logger.info(f"Caches vaciados: {eliminadas}")
     
     return {
         "success": True,
-        "ejemplos": ejemplos,
-        "total": len(ejemplos)
+        "eliminadas": eliminadas,
+        "pid": os.getpid(),
+        "timestamp": _now_str()
     }
 
 # Manejo de errores globales
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=404,
         content={
             "error": "Endpoint no encontrado",
@@ -317,7 +477,7 @@ async def not_found_handler(request, exc):
 
 @app.exception_handler(500)
 async def internal_error_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "error": "Error interno del servidor",
@@ -332,6 +492,19 @@ async def startup_event():
     # print("🚀 CUPRA Assistant API iniciada")
     logger.info("CUPRA Assistant API iniciada")
     
+    # Verificar configuración (se ejecuta tanto con `python app.py` como con `uvicorn app:app`)
+    required_vars = ['KEY_OPENAI', 'HOST', 'DBNAME', 'USER', 'PASSWORD']
+    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    
+    if missing_vars:
+        # print(f"❌ Variables de entorno faltantes: {missing_vars}")
+        logger.error(f"❌ Variables de entorno faltantes: {missing_vars}")
+        raise RuntimeError(f"Variables de entorno faltantes: {missing_vars}")
+    
+    global pipeline
+    pipeline = await run_in_threadpool(_iniciar_pipeline)
+    logger.info(f"Pool de PostgreSQL del worker: {DB_POOL_MIN}-{DB_POOL_MAX} conexiones")
+    
     # if pipeline:
     #     print("✅ Pipeline RAG disponible")
     # else:
@@ -339,10 +512,31 @@ async def startup_event():
         
     if not pipeline:
         logger.error(" Pipeline RAG no disponible")
+        raise RuntimeError("Pipeline RAG no disponible")
+    
+    # Agrupar los embeddings de las consultas concurrentes
+    embed_batcher.start(pipeline.embed_batch)
+    
+    # Ajustar hnsw.ef_search al tamaño de la tabla
+    total_filas = await run_in_threadpool(get_retriever().estimar_total_chunks)
+    ef_search = vector_config.configure_hnsw_params(total_filas)
+    logger.info(f"hnsw.ef_search = {ef_search} (~{total_filas} chunks)")
+    
+    # Cargar tiktoken (puede descargar su BPE) fuera del event loop
+    if not await run_in_threadpool(cargar_tokenizador):
+        logger.warning("tiktoken no disponible: el contexto se limita por caracteres")
+    
+    # Precalentar cliente de embeddings, conexión y plan de la búsqueda vectorial
+    embedding_warmup = await pipeline.embed_async("warmup")
+    if embedding_warmup:
+        await run_in_threadpool(
+            get_retriever().buscar_chunks_similares, "warmup", 1, logger, embedding_warmup
+        )
+    logger.info("Pipeline precalentado")
     
     # Mostrar estadísticas iniciales
     try:
-        # stats = cupra_retriever.obtener_estadisticas_bd(logger = logger)
+        # stats = get_retriever().obtener_estadisticas_bd(logger = logger)
         # print(f"📊 Base de datos: {stats.get('total_chunks', 0)} chunks disponibles")
         # logger.info(f"Base de datos: {stats.get('total_chunks', 0)} chunks disponibles")
         logger.info("Base de datos: creo que iniciada")
@@ -354,25 +548,16 @@ async def startup_event():
 async def shutdown_event():
     """Eventos al cerrar la aplicación"""
     # print("🛑 CUPRA Assistant API detenida")
+    await embed_batcher.stop()
+    await get_retriever().cerrar_async()
     logger.info("CUPRA Assistant API detenida")
+    log_config.stop_listeners()
 
 # Ejecutar la aplicación
 if __name__ == "__main__":
     import uvicorn
     
-    # Verificar configuración antes de iniciar
-    required_vars = ['KEY_OPENAI', 'HOST', 'DBNAME', 'USER', 'PASSWORD']
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
-    
-    if missing_vars:
-        # print(f"❌ Variables de entorno faltantes: {missing_vars}")
-        logger.error(f"❌ Variables de entorno faltantes: {missing_vars}")
-        exit(1)
-    
-    # Verificar estado del sistema
-    if pipeline is None:
-        print("⚠️ Advertencia: Pipeline no disponible - algunas funcionalidades pueden no funcionar")
-        logger.warning("⚠️ Advertencia: Pipeline no disponible - algunas funcionalidades pueden no funcionar")
+    # La configuración y el pipeline se verifican en startup_event
     
     # print("🌐 Iniciando servidor FastAPI...")
     # print("📱 Chatbot disponible en: http://localhost:8000")
@@ -380,9 +565,16 @@ if __name__ == "__main__":
     print("Chatbot disponible en: http://localhost:8000")
     
     # Iniciar servidor
+    # Cada worker es un proceso con su propio pipeline, pool de conexiones
+    # (DB_MAX_CONNECTIONS / WORKERS) y caches en memoria.
+    # loop/http en "auto" usan uvloop y httptools (si no, asyncio y h11, p. ej. en Windows)
     uvicorn.run(
         "app:app",
         host="0.0.0.0",
         port=8000,
+        workers=WORKERS,
+        loop="auto",
+        http="auto",
+        access_log=False,  # El logger propio ya registra las peticiones
         reload=False  # Para desarrollo
     )
\ No newline at end of file
@@ -1,6 +1,8 @@
 import os
 import time
-import json
+import orjson
+import queue
+import threading
 import logging
 import logging.handlers as handlers
 from sys import stdout, stderr
@@ -24,11 +26,21 @@ class JSONLogHandler(logging.Handler):
         self.error_counter = 1
         
         # Crear directorio si no existe
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        log_dir = os.path.dirname(filename)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
         
-        # Inicializar tamaÃ±o actual del archivo
-        if os.path.exists(filename):
-            self.current_size = os.path.getsize(filename)
+        # Stream abierto una sola vez, con buffer; se vuelca cada
+        # flush_every registros o inmediatamente en WARNING o superior
+        self.flush_every = 32
+        self._pending = 0
+        self.stream = self._open()
+        
+        # Inicializar tamaÃ±o actual del archivo (en modo 'ab' el stream empieza al final)
+        self.current_size = self.stream.tell()
+    
+    def _open(self):
+        return open(self.filename, 'ab', buffering=64*1024)
     
     def emit(self, record):
         """
@@ -39,20 +51,49 @@ class JSONLogHandler(logging.Handler):
             log_entry = self.format_json(record)
             
             # Convertir a JSON y agregar nueva lÃ­nea
-            json_line = json.dumps(log_entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+            json_bytes = orjson.dumps(log_entry, option=orjson.OPT_APPEND_NEWLINE)
             
             # Verificar si necesita rotaciÃ³n
-            if self.should_rollover(len(json_line.encode('utf-8'))):
+            if self.should_rollover(len(json_bytes)):
                 self.do_rollover()
             
             # Escribir al archivo
-            with open(self.filename, 'a', encoding='utf-8') as f:
-                f.write(json_line)
-                self.current_size += len(json_line.encode('utf-8'))
+            self.stream.write(json_bytes)
+            self.current_size += len(json_bytes)
+            self._pending += 1
+            if self._pending >= self.flush_every or record.levelno >= logging.WARNING:
+                self.flush()
                 
         except Exception:
             self.handleError(record)
     
+    def flush(self):
+        """
+        Volcar el buffer al archivo
+        """
+        self.acquire()
+        try:
+            if self.stream and not self.stream.closed:
+                self.stream.flush()
+            self._pending = 0
+        finally:
+            self.release()
+    
+    def close(self):
+        """
+        Cerrar el stream del archivo
+        """
+        self.acquire()
+        try:
+            if self.stream:
+                if not self.stream.closed:
+                    self.stream.flush()
+                    self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+            super().close()
+    
     def format_json(self, record) -> Dict[str, Any]:
         """
         Formatear el record como diccionario JSON con campos especÃ­ficos
@@ -82,24 +123,40 @@ class JSONLogHandler(logging.Handler):
         """
         Realizar la rotaciÃ³n del archivo
         """
+        # Cerrar el stream antes de renombrar el archivo
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+            self._pending = 0
+        
+        # Un solo rename con sufijo de tiempo (ms) en lugar de la cadena .1 .. .N
         if os.path.exists(self.filename):
-            # Rotar archivos existentes
-            for i in range(self.backup_count - 1, 0, -1):
-                old_name = f"{self.filename}.{i}"
-                new_name = f"{self.filename}.{i + 1}"
-                if os.path.exists(old_name):
-                    if os.path.exists(new_name):
-                        os.remove(new_name)
-                    os.rename(old_name, new_name)
-            
-            # Mover archivo actual
-            backup_name = f"{self.filename}.1"
-            if os.path.exists(backup_name):
-                os.remove(backup_name)
-            os.rename(self.filename, backup_name)
+            os.rename(self.filename, f"{self.filename}.{int(time.time() * 1000)}")
             
             # Resetear tamaÃ±o
             self.current_size = 0
+            
+            # Borrar los backups sobrantes fuera del camino del log
+            threading.Thread(target=self._prune_backups, daemon=True).start()
+        
+        self.stream = self._open()
+    
+    def _prune_backups(self):
+        """
+        Mantener solo los backup_count backups mas recientes
+        """
+        try:
+            directorio = os.path.dirname(self.filename) or '.'
+            prefijo = os.path.basename(self.filename) + '.'
+            backups = sorted(
+                (nombre for nombre in os.listdir(directorio)
+                 if nombre.startswith(prefijo) and nombre[len(prefijo):].isdigit()),
+                key=lambda nombre: int(nombre[len(prefijo):])
+            )
+            for nombre in backups[:-self.backup_count] if self.backup_count > 0 else backups:
+                os.remove(os.path.join(directorio, nombre))
+        except OSError:
+            pass
 
 class SizedTimedRotatingFileHandler(handlers.TimedRotatingFileHandler):
     """
@@ -143,8 +200,8 @@ def create_rotating_log(path, level, enable_log_file=True, enable_json_file=Fals
     """
     # Crear directorio si no existe
     log_dir = os.path.dirname(path)
-    if log_dir and not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
     
     # Configurar logging bÃ¡sico
     logging.basicConfig(
@@ -157,9 +214,14 @@ def create_rotating_log(path, level, enable_log_file=True, enable_json_file=Fals
     logger_name = os.path.splitext(os.path.basename(path))[0]
     logger = logging.getLogger(logger_name)
     
-    # Limpiar handlers existentes
+    # Limpiar handlers existentes (y parar su listener si lo hay)
+    log_config.stop_listener(logger_name)
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
+        handler.close()
+    
+    # Handlers reales; se ejecutan en el hilo del QueueListener
+    destinos = []
     
     # Handler para archivo .log (opcional)
     if enable_log_file:
@@ -173,7 +235,7 @@ def create_rotating_log(path, level, enable_log_file=True, enable_json_file=Fals
         )
         file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
+        destinos.append(file_handler)
     
     # Handler para archivo .json (opcional)
     if enable_json_file:
@@ -183,7 +245,7 @@ def create_rotating_log(path, level, enable_log_file=True, enable_json_file=Fals
             max_bytes=500*(1024**2),
             backup_count=5
         )
-        logger.addHandler(json_handler)
+        destinos.append(json_handler)
     
     # Handler para stdout (INFO y DEBUG)
     stdout_handler = logging.StreamHandler(stdout)
@@ -197,14 +259,21 @@ def create_rotating_log(path, level, enable_log_file=True, enable_json_file=Fals
             return record.levelno <= logging.INFO
     
     stdout_handler.addFilter(StdoutFilter())
-    logger.addHandler(stdout_handler)
+    destinos.append(stdout_handler)
     
     # Handler para stderr (WARNING, ERROR, CRITICAL)
     stderr_handler = logging.StreamHandler(stderr)
     stderr_handler.setLevel(logging.WARNING)
     stderr_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     stderr_handler.setFormatter(stderr_formatter)
-    logger.addHandler(stderr_handler)
+    destinos.append(stderr_handler)
+    
+    # El logger solo encola el record; el QueueListener lo escribe en segundo plano
+    log_queue = queue.Queue(-1)
+    logger.addHandler(handlers.QueueHandler(log_queue))
+    listener = handlers.QueueListener(log_queue, *destinos, respect_handler_level=True)
+    listener.start()
+    log_config.set_listener(logger_name, listener)
     
     # Configurar nivel de logging
     nivel = level.lower()
@@ -234,6 +303,7 @@ class LogConfig:
         self.level_log = "info"
         self.enable_log_files = False      # Control para archivos .log
         self.enable_json_files = False     # Control para archivos .json
+        self.listeners = {}                # QueueListener activo por logger
     
     def set_logs_folder(self, folder):
         self.logs_folder = folder
@@ -248,6 +318,43 @@ class LogConfig:
     def set_json_files(self, enable):
         """Habilitar/deshabilitar archivos .json"""
         self.enable_json_files = enable
+    
+    def set_listener(self, logger_name, listener):
+        """Registrar el QueueListener de un logger"""
+        self.listeners[logger_name] = listener
+    
+    def stop_listener(self, logger_name):
+        """Parar el QueueListener de un logger vaciando su cola"""
+        listener = self.listeners.pop(logger_name, None)
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+    
+    def stop_listeners(self):
+        """Parar todos los QueueListener (al cerrar la aplicacion)"""
+        for logger_name in list(self.listeners):
+            self.stop_listener(logger_name)
 
 # Instancia global de configuraciÃ³n
-log_config = LogConfig()
\ No newline at end of file
+log_config = LogConfig()
+
+# Configuracion global de busqueda vectorial
+class VectorConfig:
+    def __init__(self):
+        self.ef_search = 40  # Valor por defecto de pgvector
+    
+    def configure_hnsw_params(self, num_filas):
+        """Ajustar hnsw.ef_search segun el numero de filas de la tabla"""
+        # Valores ~20% por encima de los habituales para compensar
+        # la perdida de recall de los embeddings halfvec (fp16)
+        if num_filas < 100_000:
+            self.ef_search = 48
+        elif num_filas < 1_000_000:
+            self.ef_search = 120
+        else:
+            self.ef_search = 240
+        return self.ef_search
+
+# Instancia global de configuracion vectorial
+vector_config = VectorConfig()
\ No newline at end of file
@@ -0,0 +1,100 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+MAX_BATCH = 32
+MAX_WAIT_MS = 10
+
+
+class EmbedBatcher:
+    """
+    Agrupa las peticiones de embedding concurrentes en una sola llamada.
+
+    Cada petición se encola junto a un Future; una tarea en segundo plano
+    espera hasta MAX_WAIT_MS (o hasta juntar MAX_BATCH textos), lanza un único
+    embedding en lote asíncrono y resuelve los Futures con su resultado.
+    """
+
+    def __init__(self, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._embed_fn: Optional[Callable[[List[str]], Awaitable[List[List[float]]]]] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pendientes: Set[asyncio.Task] = set()
+
+    def start(self, embed_fn: Callable[[List[str]], Awaitable[List[List[float]]]]):
+        """
+        Arranca la tarea de agrupación en el event loop actual
+
+        Args:
+            embed_fn: Corrutina que recibe una lista de textos y devuelve sus embeddings
+        """
+        self._embed_fn = embed_fn
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detiene la tarea de agrupación"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def embed(self, text: str) -> List[float]:
+        """
+        Obtiene el embedding de un texto compartiendo llamada con las peticiones concurrentes
+
+        Args:
+            text: Texto a convertir
+
+        Returns:
+            Embedding del texto (lista vacía si falla)
+        """
+        if self._task is None or self._task.done():
+            raise RuntimeError("EmbedBatcher no iniciado")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            lote: List[Tuple[str, asyncio.Future]] = [await self._queue.get()]
+            limite = loop.time() + self.max_wait
+
+            while len(lote) < self.max_batch:
+                restante = limite - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(await asyncio.wait_for(self._queue.get(), restante))
+                except asyncio.TimeoutError:
+                    break
+
+            # El lote se resuelve aparte para seguir agrupando mientras tanto
+            tarea = asyncio.create_task(self._procesar_lote(lote))
+            self._pendientes.add(tarea)
+            tarea.add_done_callback(self._pendientes.discard)
+
+    async def _procesar_lote(self, lote: List[Tuple[str, asyncio.Future]]):
+        textos = [texto for texto, _ in lote]
+        try:
+            embeddings = await self._embed_fn(textos)
+        except Exception as e:
+            for _, future in lote:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), embedding in zip(lote, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+
+# Instancia global del batcher de embeddings
+embed_batcher = EmbedBatcher()
@@ -0,0 +1,101 @@
+from services.llm.cupra_retrieval import get_retriever
+
+# Dimensión de los embeddings (text-embedding-ada-002 / text-embedding-3-small)
+EMBEDDING_DIM = 1536
+
+# Índice HNSW sobre la columna halfvec
+INDICE_HNSW = "cupra_chunks_embedding_hnsw"
+SQL_CREAR_INDICE_HNSW = f"""
+CREATE INDEX IF NOT EXISTS {INDICE_HNSW}
+ON cupra_chunks USING hnsw (embedding halfvec_cosine_ops)
+WITH (m = 24, ef_construction = 128);
+"""
+
+# Variante sin bloqueo de escrituras para construir el índice con la app en marcha.
+# No admite transacción: requiere una conexión en autocommit
+SQL_CREAR_INDICE_HNSW_CONCURRENTE = f"""
+CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDICE_HNSW}
+ON cupra_chunks USING hnsw (embedding halfvec_cosine_ops)
+WITH (m = 24, ef_construction = 128);
+"""
+
+# Un CONCURRENTLY fallido o interrumpido deja el índice marcado como inválido;
+# se considera abandonado si ningún proceso lo está construyendo
+SQL_INDICE_HNSW_ABANDONADO = f"""
+SELECT EXISTS (
+    SELECT FROM pg_index
+    WHERE indexrelid = to_regclass('{INDICE_HNSW}') AND NOT indisvalid
+) AND NOT EXISTS (
+    SELECT FROM pg_stat_progress_create_index
+    WHERE index_relid = to_regclass('{INDICE_HNSW}')
+);
+"""
+SQL_ELIMINAR_INDICE_HNSW_CONCURRENTE = f"DROP INDEX CONCURRENTLY IF EXISTS {INDICE_HNSW};"
+
+# Tras CREATE ... IF NOT EXISTS: distingue un índice recién creado de uno omitido
+SQL_INDICE_HNSW_VALIDO = f"""
+SELECT EXISTS (
+    SELECT FROM pg_index
+    WHERE indexrelid = to_regclass('{INDICE_HNSW}') AND indisvalid
+);
+"""
+
+SQL_TIPO_EMBEDDING = """
+SELECT format_type(a.atttypid, a.atttypmod)
+FROM pg_attribute a
+WHERE a.attrelid = 'cupra_chunks'::regclass
+AND a.attname = 'embedding';
+"""
+
+SQL_INDICES_EMBEDDING = """
+SELECT indexname FROM pg_indexes
+WHERE tablename = 'cupra_chunks'
+AND indexname LIKE '%embedding%';
+"""
+
+SQL_ALTER_HALFVEC = f"""
+ALTER TABLE cupra_chunks
+ALTER COLUMN embedding TYPE halfvec({EMBEDDING_DIM})
+USING embedding::halfvec({EMBEDDING_DIM});
+"""
+
+
+def migrar_embedding_halfvec():
+    """
+    Migra cupra_chunks.embedding de vector (fp32) a halfvec (fp16) y reconstruye el índice HNSW
+
+    Los índices con operadores de vector no son válidos para halfvec, así que
+    se eliminan antes del ALTER. La migración es idempotente.
+    """
+    with get_retriever()._get_connection() as conn:
+        try:
+            cur = conn.cursor()
+
+            cur.execute(SQL_TIPO_EMBEDDING)
+            tipo_actual = cur.fetchone()[0]
+            print(f"📋 Tipo actual de embedding: {tipo_actual}")
+
+            if not tipo_actual.startswith("halfvec"):
+                cur.execute(SQL_INDICES_EMBEDDING)
+                for (indice,) in cur.fetchall():
+                    print(f"🗑️ Eliminando índice {indice}")
+                    cur.execute(f'DROP INDEX IF EXISTS "{indice}";')
+
+                print(f"🔄 Convirtiendo embedding a halfvec({EMBEDDING_DIM})...")
+                cur.execute(SQL_ALTER_HALFVEC)
+
+            print(f"🏗️ Creando índice {INDICE_HNSW} (si no existe)...")
+            cur.execute(SQL_CREAR_INDICE_HNSW)
+
+            conn.commit()
+            cur.close()
+            print("✅ Migración a halfvec completada")
+
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Error en la migración a halfvec: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    migrar_embedding_halfvec()
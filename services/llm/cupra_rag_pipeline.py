@@ -1,9 +1,22 @@
+import asyncio
+import hashlib
 import json
+import logging
+import orjson
 import os
-from typing import List, Dict, Any
-from openai import OpenAI
+import re
+import sys
+import uuid
+from collections import OrderedDict
+from typing import List, Dict, Any, AsyncIterator, Callable, Optional, Set
 from dotenv import load_dotenv
-from services.llm.cupra_retrieval import busqueda_cupra_chunks, cupra_retriever
+from services.llm.cupra_retrieval import busqueda_cupra_chunks, busqueda_cupra_chunks_batch, get_retriever, crear_chat_async
+from services.retrieval_cache import retrieval_cache
+
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None  # sin tiktoken el presupuesto se estima por caracteres
 
 load_dotenv()
 
@@ -11,8 +24,127 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv('KEY_OPENAI')
 MODEL_GPT = os.getenv('MODEL_LLM', 'gpt-4o-mini')
 
-# Configurar cliente OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Evaluar la calidad en segundo plano en lugar de en el camino crítico de /api/chat
+QUALITY_AGENT_ASYNC = os.getenv('QUALITY_AGENT_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+# Máximo de evaluaciones en segundo plano que se conservan
+EVALUACIONES_MAX = 1000
+
+# Límites del contexto inyectado en el prompt (el prefill domina la latencia)
+CHUNK_MAX_CHARS = 800
+CONTEXTO_MAX_TOKENS = 2500
+_ESPACIOS = re.compile(r"\s+")
+
+# Prompts de sistema fijos: forman un prefijo idéntico en todas las llamadas,
+# de modo que OpenAI puede reutilizarlo (prompt caching)
+CUPRA_SYSTEM_PROMPT = """Eres un asistente técnico especializado en vehículos CUPRA. Responde ÚNICAMENTE basándote en la información del manual oficial proporcionada. Si no tienes información suficiente, indícalo claramente. Mantén un tono profesional pero accesible.
+
+Basándote EXCLUSIVAMENTE en la información del manual oficial de CUPRA que aparece en el mensaje del usuario, responde su consulta de manera precisa y útil.
+
+INSTRUCCIONES DE FORMATO Y CONTENIDO:
+1. Responde ÚNICAMENTE basándote en la información proporcionada del manual
+2. IMPORTANTE - Estructura tu respuesta de forma clara y legible:
+   - Usa SALTOS DE LÍNEA entre secciones principales
+   - Para pasos numerados, pon cada paso en una nueva línea
+   - Separa claramente las secciones (ej: pasos principales, condiciones, precauciones)
+   - Usa **negrita** para títulos de secciones importantes
+   - Deja una línea en blanco entre párrafos diferentes
+3. Si hay procedimientos paso a paso:
+   - Numera cada paso principal (1., 2., 3., etc.)
+   - Los sub-pasos van con guiones (-)
+   - Cada paso en su propia línea
+4. Agrupa la información en secciones lógicas como:
+   - Pasos principales
+   - Condiciones importantes
+   - Precauciones o advertencias
+   - Información adicional
+5. Mantén un tono profesional pero accesible
+6. Si la información no es suficiente, indícalo claramente al final
+
+FORMATO DE EJEMPLO para respuestas con pasos:
+
+**Título de la función**
+
+**Pasos principales:**
+
+1. **Primer paso**
+   - Detalle del paso
+   - Otro detalle si es necesario
+
+2. **Segundo paso**
+   - Explicación clara
+
+**Condiciones importantes:**
+- Primera condición
+- Segunda condición
+
+**Precauciones:**
+⚠️ Advertencia importante"""
+
+QUALITY_SYSTEM_PROMPT = """Eres un evaluador de calidad de respuestas técnicas sobre vehículos CUPRA. Evalúa del 1 al 10 la calidad de la respuesta que recibirás junto a su consulta.
+
+CRITERIOS DE EVALUACIÓN:
+1. Relevancia: ¿Responde directamente a la consulta?
+2. Precisión: ¿Es técnicamente correcta?
+3. Completitud: ¿Cubre los aspectos importantes?
+4. Claridad: ¿Es fácil de entender?
+5. Fundamentación: ¿Está basada en la información proporcionada?
+
+Responde SOLO con el número del 1 al 10."""
+
+# Claves de enrutado del prompt cache: versionadas por el contenido del prompt de
+# sistema, cambian solas si se edita el prompt
+CUPRA_PROMPT_CACHE_KEY = "cupra-" + hashlib.md5(CUPRA_SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+QUALITY_PROMPT_CACHE_KEY = "cupra-quality-" + hashlib.md5(QUALITY_SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+
+# Las llamadas al chat pasan por crear_chat_async (cliente AsyncOpenAI compartido,
+# reintentos y límite de concurrencia)
+
+# Codificación de tiktoken, cargada una vez con cargar_tokenizador(); mientras
+# sea None los tokens se estiman por caracteres
+_codificacion = None
+
+def cargar_tokenizador() -> bool:
+    """
+    Carga la codificación de tiktoken para MODEL_GPT
+    
+    tiktoken descarga el fichero BPE la primera vez, así que debe llamarse al
+    arrancar y desde un hilo, nunca en el camino de una petición. Si la carga
+    falla se mantiene la estimación por caracteres.
+    
+    Returns:
+        True si la codificación quedó cargada
+    """
+    global _codificacion
+    if _codificacion is not None:
+        return True
+    if tiktoken is None:
+        return False
+    try:
+        try:
+            _codificacion = tiktoken.encoding_for_model(MODEL_GPT)
+        except KeyError:
+            _codificacion = tiktoken.get_encoding("o200k_base")
+        return True
+    except Exception as e:
+        print(f"⚠️ No se pudo cargar tiktoken, se estiman los tokens por caracteres: {e}")
+        return False
+
+def _recortar_a_tokens(texto: str, max_tokens: int) -> tuple:
+    """
+    Recorta un texto a un máximo de tokens
+    
+    Returns:
+        Tupla (texto recortado, tokens usados)
+    """
+    codificacion = _codificacion
+    if codificacion is None:
+        # Estimación aproximada: ~4 caracteres por token
+        recortado = texto[:max_tokens * 4]
+        return recortado, (len(recortado) + 3) // 4
+    tokens = codificacion.encode(texto)
+    if len(tokens) <= max_tokens:
+        return texto, len(tokens)
+    return codificacion.decode(tokens[:max_tokens]), max_tokens
 
 class CupraRAGPipeline:
     """Pipeline RAG completo para asistencia CUPRA: RAG → LLM → Quality Agent"""
@@ -23,27 +155,68 @@ class CupraRAGPipeline:
         
         self.logger = logger
         
+        # Evaluaciones de calidad en segundo plano, indexadas por request_id
+        self._evaluaciones: "OrderedDict[str, str]" = OrderedDict()
+        self._tareas_calidad: Set[asyncio.Task] = set()
+        
         # Verificar conexión a base de datos
-        salud_bd = cupra_retriever.verificar_salud_bd()
+        salud_bd = get_retriever().verificar_salud_bd()
         if not salud_bd['conexion_ok']:
             # self.logger.error("❌ No se puede conectar a la base de datos PostgreSQL")
             raise Exception("❌ No se puede conectar a la base de datos PostgreSQL")
         
         # Verificar que hay datos
-        stats = cupra_retriever.obtener_estadisticas_bd()
+        stats = get_retriever().obtener_estadisticas_bd()
         if stats.get('total_chunks', 0) == 0:
             # self.logger.error("❌ No hay chunks en la base de datos")
             raise Exception("❌ No hay chunks en la base de datos")
         
         # self.logger.info(f"✅ Pipeline inicializado - {stats.get('total_chunks', 0)} chunks disponibles")
     
-    def paso_1_rag(self, query: str, top_k: int = 4) -> List[Dict]:
+    def embed(self, query: str) -> List[float]:
+        """
+        Genera el embedding de una consulta con el mismo modelo usado en el RAG
+        
+        Args:
+            query: Consulta del usuario
+            
+        Returns:
+            Embedding de la consulta (lista vacía si falla)
+        """
+        return get_retriever().generar_embedding_query(query, logger=self.logger)
+    
+    async def embed_async(self, query: str) -> List[float]:
+        """
+        Versión asíncrona de embed
+        
+        Args:
+            query: Consulta del usuario
+            
+        Returns:
+            Embedding de la consulta (lista vacía si falla)
+        """
+        return await get_retriever().generar_embedding_query_async(query, logger=self.logger)
+    
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        """
+        Genera los embeddings de varias consultas en una sola llamada
+        
+        Args:
+            queries: Lista de consultas
+            
+        Returns:
+            Lista de embeddings en el mismo orden que las consultas
+        """
+        return await get_retriever().generar_embeddings_queries_async(queries, logger=self.logger)
+    
+    def paso_1_rag(self, query: str, top_k: int = 4, query_embedding: List[float] = None) -> List[Dict]:
         """
         PASO 1: RAG - Recuperación de información relevante
         
         Args:
             query: Consulta del usuario
             top_k: Número de chunks a recuperar (default: 4)
+            query_embedding: Embedding ya calculado de la consulta (opcional)
             
         Returns:
             Lista de chunks más relevantes con similitud coseno
@@ -52,8 +225,20 @@ class CupraRAGPipeline:
         self.logger.info(f"PASO 1 - RAG: Buscando información para '{query}'...")
         
         try:
+            # Consultar primero el cache de recuperación
+            if query_embedding is None:
+                query_embedding = self.embed(query) or None
+            if query_embedding is not None:
+                resultados = retrieval_cache.get(query_embedding, top_k)
+                if resultados is not None:
+                    self.logger.info(f" RAG desde cache: {len(resultados)} chunks recuperados")
+                    return resultados
+            
             # Usar el sistema de búsqueda vectorial
-            resultados = busqueda_cupra_chunks(query, top_k=top_k, logger = self.logger)
+            resultados = busqueda_cupra_chunks(query, top_k=top_k, logger = self.logger, query_embedding=query_embedding)
+            
+            if resultados and query_embedding is not None:
+                retrieval_cache.put(query_embedding, top_k, resultados)
             
             if resultados:
                 # print(f"✅ RAG exitoso: {len(resultados)} chunks recuperados")
@@ -73,7 +258,52 @@ class CupraRAGPipeline:
             self.logger.warning(f"❌ Error en PASO 1 - RAG: {e}")
             return []
     
-    def paso_2_llm(self, query: str, chunks_relevantes: List[Dict]) -> Dict[str, Any]:
+    def paso_1_rag_batch(self, queries: List[str], top_k: int = 4,
+                         query_embeddings: List[List[float]] = None) -> List[List[Dict]]:
+        """
+        PASO 1 para varias consultas: las que no están en el cache de
+        recuperación se buscan juntas en una sola consulta SQL
+        
+        Args:
+            queries: Lista de consultas
+            top_k: Número de chunks a recuperar por consulta (default: 4)
+            query_embeddings: Embeddings ya calculados de las consultas (opcional)
+            
+        Returns:
+            Lista de listas de chunks, en el mismo orden que las consultas
+        """
+        self.logger.info(f"PASO 1 - RAG (lote): Buscando información para {len(queries)} consultas...")
+        
+        if query_embeddings is None:
+            query_embeddings = get_retriever().generar_embeddings_queries(queries, logger=self.logger)
+        
+        resultados: List[List[Dict]] = [[] for _ in queries]
+        pendientes = []
+        for i, embedding in enumerate(query_embeddings):
+            # Las consultas sin embedding se quedan sin resultados
+            if not embedding:
+                continue
+            cacheados = retrieval_cache.get(embedding, top_k)
+            if cacheados is not None:
+                resultados[i] = cacheados
+            else:
+                pendientes.append(i)
+        
+        if pendientes:
+            encontrados = busqueda_cupra_chunks_batch(
+                [queries[i] for i in pendientes], top_k, logger=self.logger,
+                query_embeddings=[query_embeddings[i] for i in pendientes]
+            )
+            for i, chunks in zip(pendientes, encontrados):
+                resultados[i] = chunks
+                if chunks:
+                    retrieval_cache.put(query_embeddings[i], top_k, chunks)
+        
+        self.logger.info(f" RAG (lote): {len(queries) - len(pendientes)} consultas desde cache, "
+                         f"{len(pendientes)} buscadas")
+        return resultados
+    
+    async def paso_2_llm(self, query: str, chunks_relevantes: List[Dict]) -> Dict[str, Any]:
         """
         PASO 2: LLM - Generación de respuesta con contexto
         
@@ -82,72 +312,37 @@ class CupraRAGPipeline:
             chunks_relevantes: Chunks recuperados del RAG
             
         Returns:
-            Diccionario con la respuesta generada y metadatos
+            Diccionario con la respuesta generada y metadatos ('error': True si falló la llamada)
         """
         # print(f"🤖 PASO 2 - LLM: Generando respuesta...")
         self.logger.info(f"PASO 2 - LLM: Generando respuesta...")
         
         if not chunks_relevantes:
             self.logger.error("No se encontro información relevante en el manual CUPRA")
-            return {
-                'respuesta': "Lo siento, no encontré información relevante en el manual de CUPRA para responder tu consulta. ¿Podrías reformular tu pregunta o ser más específico?",
-                'contexto_usado': [],
-                'confianza': 0.0,
-                'fuentes': []
-            }
+            return self._resultado_sin_contexto()
         
         try:
             # Construir contexto desde los chunks
             self.logger.debug("Construyendo contexto desde los chunks")
             contexto = self._construir_contexto(chunks_relevantes)
             
-            # Crear prompt especializado para CUPRA
-            self.logger.debug("Creando prompt")
-            prompt = self._crear_prompt_cupra(query, contexto)
-            
             # Llamar al LLM
             self.logger.debug("haciendo llamada al llm")
-            respuesta = client.chat.completions.create(
+            respuesta = await crear_chat_async(
                 model=MODEL_GPT,
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": "Eres un asistente técnico especializado en vehículos CUPRA. Responde ÚNICAMENTE basándote en la información del manual oficial proporcionada. Si no tienes información suficiente, indícalo claramente. Mantén un tono profesional pero accesible."
-                    },
-                    {
-                        "role": "user", 
-                        "content": prompt
-                    }
-                ],
+                messages=self._mensajes_cupra(query, contexto),
                 temperature=0.3,  # Baja temperatura para respuestas más consistentes
-                max_tokens=1000
+                max_tokens=1000,
+                # openai==1.93 aún no expone prompt_cache_key como argumento
+                extra_body={"prompt_cache_key": CUPRA_PROMPT_CACHE_KEY}
             )
+            self._registrar_cache_prompt("PASO 2", respuesta.usage)
             
             respuesta_texto = respuesta.choices[0].message.content
-            
-            # Calcular confianza promedio basada en similitud de chunks
-            confianza = sum(chunk['similitud'] for chunk in chunks_relevantes) / len(chunks_relevantes)
-            
-            # Extraer información de fuentes
-            fuentes = [
-                {
-                    'titulo': chunk['titulo'],
-                    'similitud': chunk['similitud'],
-                    'subchunk': chunk['subchunk'],
-                    'chunk_id': chunk['chunk_id']
-                }
-                for chunk in chunks_relevantes
-            ]
-            
-            resultado = {
-                'respuesta': respuesta_texto,
-                'contexto_usado': contexto,
-                'confianza': confianza,
-                'fuentes': fuentes
-            }
+            resultado = self._resultado_llm(respuesta_texto, contexto, chunks_relevantes)
             
             # print(f"✅ LLM: Respuesta generada (Confianza: {confianza:.2f})")
-            self.logger.info(f" LLM Confianza: {confianza:.2f}")
+            self.logger.info(f" LLM Confianza: {resultado['confianza']:.2f}")
             return resultado
             
         except Exception as e:
@@ -157,10 +352,132 @@ class CupraRAGPipeline:
                 'respuesta': f"Error generando respuesta: {str(e)}",
                 'contexto_usado': [],
                 'confianza': 0.0,
-                'fuentes': []
+                'fuentes': [],
+                'error': True
             }
     
-    def paso_3_quality_agent(self, query: str, respuesta_llm: Dict[str, Any]) -> str:
+    async def paso_2_llm_stream(self, query: str, chunks_relevantes: List[Dict], contexto: List[str]) -> AsyncIterator[str]:
+        """
+        PASO 2 en streaming: devuelve los fragmentos de texto según los emite el LLM
+        
+        Args:
+            query: Consulta original del usuario
+            chunks_relevantes: Chunks recuperados del RAG (no vacío)
+            contexto: Contexto ya construido desde los chunks
+            
+        Yields:
+            Fragmentos de la respuesta generada
+        """
+        self.logger.info(f"PASO 2 - LLM: Generando respuesta en streaming...")
+        
+        stream = await crear_chat_async(
+            model=MODEL_GPT,
+            messages=self._mensajes_cupra(query, contexto),
+            temperature=0.3,
+            max_tokens=1000,
+            stream=True,
+            # El último fragmento trae el uso de tokens (sin choices)
+            stream_options={"include_usage": True},
+            extra_body={"prompt_cache_key": CUPRA_PROMPT_CACHE_KEY}
+        )
+        
+        async for chunk in stream:
+            if chunk.usage is not None:
+                self._registrar_cache_prompt("PASO 2 (stream)", chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    
+    async def paso_2_llm_con_tokens(self, query: str, chunks_relevantes: List[Dict], on_token: Callable[[str], None]) -> Dict[str, Any]:
+        """
+        PASO 2 en streaming entregando cada fragmento a on_token según llega
+        
+        Args:
+            query: Consulta original del usuario
+            chunks_relevantes: Chunks recuperados del RAG
+            on_token: Función llamada con cada fragmento de texto
+            
+        Returns:
+            El mismo diccionario que paso_2_llm, con la respuesta completa
+        """
+        if not chunks_relevantes:
+            resultado = self._resultado_sin_contexto()
+            on_token(resultado['respuesta'])
+            return resultado
+        
+        contexto = self._construir_contexto(chunks_relevantes)
+        partes = []
+        try:
+            async for texto in self.paso_2_llm_stream(query, chunks_relevantes, contexto):
+                partes.append(texto)
+                on_token(texto)
+        except Exception as e:
+            self.logger.warning(f"❌ Error en PASO 2 - LLM (stream): {e}")
+            return {
+                'respuesta': f"Error generando respuesta: {str(e)}",
+                'contexto_usado': [],
+                'confianza': 0.0,
+                'fuentes': [],
+                'error': True
+            }
+        
+        resultado = self._resultado_llm("".join(partes), contexto, chunks_relevantes)
+        self.logger.info(f" LLM Confianza: {resultado['confianza']:.2f}")
+        return resultado
+    
+    def _registrar_cache_prompt(self, paso: str, usage):
+        """Registra cuántos tokens del prompt sirvió el prompt cache de OpenAI"""
+        if usage is None:
+            return
+        detalles = getattr(usage, 'prompt_tokens_details', None)
+        cacheados = (getattr(detalles, 'cached_tokens', None) or 0) if detalles else 0
+        self.logger.info(f"{paso} - prompt cache: {cacheados}/{usage.prompt_tokens} tokens cacheados")
+    
+    def _mensajes_cupra(self, query: str, contexto: List[str]) -> List[Dict[str, str]]:
+        """Mensajes enviados al LLM para generar la respuesta CUPRA"""
+        return [
+            {
+                "role": "system", 
+                "content": CUPRA_SYSTEM_PROMPT
+            },
+            {
+                "role": "user", 
+                "content": self._crear_prompt_cupra(query, contexto)
+            }
+        ]
+    
+    def _resultado_llm(self, respuesta_texto: str, contexto: List[str], chunks_relevantes: List[Dict]) -> Dict[str, Any]:
+        """Construye el resultado del PASO 2 a partir del texto generado"""
+        # Calcular confianza promedio basada en similitud de chunks
+        confianza = sum(chunk['similitud'] for chunk in chunks_relevantes) / len(chunks_relevantes)
+        
+        # Extraer información de fuentes
+        fuentes = [
+            {
+                'titulo': chunk['titulo'],
+                'similitud': chunk['similitud'],
+                'subchunk': chunk['subchunk'],
+                'chunk_id': chunk['chunk_id']
+            }
+            for chunk in chunks_relevantes
+        ]
+        
+        return {
+            'respuesta': respuesta_texto,
+            'contexto_usado': contexto,
+            'confianza': confianza,
+            'fuentes': fuentes
+        }
+    
+    def _resultado_sin_contexto(self) -> Dict[str, Any]:
+        """Resultado del PASO 2 cuando el RAG no devuelve chunks"""
+        return {
+            'respuesta': "Lo siento, no encontré información relevante en el manual de CUPRA para responder tu consulta. ¿Podrías reformular tu pregunta o ser más específico?",
+            'contexto_usado': [],
+            'confianza': 0.0,
+            'fuentes': []
+        }
+    
+    async def paso_3_quality_agent(self, query: str, respuesta_llm: Dict[str, Any]) -> str:
         """
         PASO 3: Quality Agent - Evaluación de calidad de la respuesta
         
@@ -179,12 +496,12 @@ class CupraRAGPipeline:
             prompt_quality = self._crear_prompt_quality(query, respuesta_llm)
             
             # Evaluar calidad
-            evaluacion = client.chat.completions.create(
+            evaluacion = await crear_chat_async(
                 model=MODEL_GPT,
                 messages=[
                     {
                         "role": "system", 
-                        "content": "Eres un evaluador de calidad de respuestas técnicas. Evalúa la respuesta del 1 al 10 considerando: relevancia, precisión, completitud, claridad y fundamentación. Responde SOLO con el número."
+                        "content": QUALITY_SYSTEM_PROMPT
                     },
                     {
                         "role": "user", 
@@ -192,8 +509,10 @@ class CupraRAGPipeline:
                     }
                 ],
                 temperature=0.1,
-                max_tokens=10
+                max_tokens=10,
+                extra_body={"prompt_cache_key": QUALITY_PROMPT_CACHE_KEY}
             )
+            self._registrar_cache_prompt("PASO 3", evaluacion.usage)
             
             evaluacion_texto = evaluacion.choices[0].message.content.strip()
             
@@ -219,102 +538,61 @@ class CupraRAGPipeline:
             return "5"  # Puntuación por defecto
     
     def _construir_contexto(self, chunks: List[Dict]) -> List[str]:
-        """Construye el contexto a partir de los chunks relevantes"""
+        """
+        Construye el contexto a partir de los chunks relevantes
+        
+        El contenido de cada chunk se compacta (espacios), se limita a
+        CHUNK_MAX_CHARS y el total se corta en CONTEXTO_MAX_TOKENS; el último
+        chunk que no cabe entero se trunca en el límite.
+        """
         contexto_partes = []
+        tokens_restantes = CONTEXTO_MAX_TOKENS
         
         for i, chunk in enumerate(chunks, 1):
+            if tokens_restantes <= 0:
+                break
+            contenido = _ESPACIOS.sub(" ", chunk['cont']).strip()[:CHUNK_MAX_CHARS]
+            contenido, tokens_usados = _recortar_a_tokens(contenido, tokens_restantes)
+            tokens_restantes -= tokens_usados
+            
             contexto_parte = f"INFORMACIÓN {i}:\n"
             contexto_parte += f"Título: {chunk['titulo']}\n"
             if chunk['subchunk'] > 0:
                 contexto_parte += f"Sección: {chunk['subchunk']}\n"
-            contexto_parte += f"Contenido: {chunk['cont']}\n"
+            contexto_parte += f"Contenido: {contenido}\n"
             contexto_partes.append(contexto_parte)
         
         return contexto_partes
     
     def _crear_prompt_cupra(self, query: str, contexto: List[str]) -> str:
-        """Crea el prompt especializado para CUPRA"""
-        contexto_str = "\n\n".join(contexto)
-        
-        prompt = f"""Basándote EXCLUSIVAMENTE en la siguiente información del manual oficial de CUPRA, responde la consulta del usuario de manera precisa y útil.
-
-INFORMACIÓN DEL MANUAL CUPRA:
-{contexto_str}
-
-CONSULTA DEL USUARIO:
-{query}
-
-INSTRUCCIONES DE FORMATO Y CONTENIDO:
-1. Responde ÚNICAMENTE basándote en la información proporcionada del manual
-2. IMPORTANTE - Estructura tu respuesta de forma clara y legible:
-   - Usa SALTOS DE LÍNEA entre secciones principales
-   - Para pasos numerados, pon cada paso en una nueva línea
-   - Separa claramente las secciones (ej: pasos principales, condiciones, precauciones)
-   - Usa **negrita** para títulos de secciones importantes
-   - Deja una línea en blanco entre párrafos diferentes
-3. Si hay procedimientos paso a paso:
-   - Numera cada paso principal (1., 2., 3., etc.)
-   - Los sub-pasos van con guiones (-)
-   - Cada paso en su propia línea
-4. Agrupa la información en secciones lógicas como:
-   - Pasos principales
-   - Condiciones importantes
-   - Precauciones o advertencias
-   - Información adicional
-5. Mantén un tono profesional pero accesible
-6. Si la información no es suficiente, indícalo claramente al final
-
-FORMATO DE EJEMPLO para respuestas con pasos:
-
-**Título de la función**
-
-**Pasos principales:**
-
-1. **Primer paso**
-   - Detalle del paso
-   - Otro detalle si es necesario
-
-2. **Segundo paso**
-   - Explicación clara
-
-**Condiciones importantes:**
-- Primera condición
-- Segunda condición
-
-**Precauciones:**
-⚠️ Advertencia importante
-
-RESPUESTA:"""
+        """
+        Crea el mensaje de usuario para CUPRA
         
-        return prompt
+        Las instrucciones fijas viven en CUPRA_SYSTEM_PROMPT; aquí solo va lo
+        variable (chunks y consulta), al final del prompt.
+        """
+        contexto_str = "\n\n".join(contexto)
+        return f"INFORMACIÓN DEL MANUAL CUPRA:\n{contexto_str}\n\nCONSULTA DEL USUARIO:\n{query}\n\nRESPUESTA:"
     
     def _crear_prompt_quality(self, query: str, respuesta_llm: Dict[str, Any]) -> str:
-        """Crea el prompt para evaluación de calidad"""
-        prompt = f"""Evalúa del 1 al 10 la calidad de esta respuesta sobre vehículos CUPRA:
-
-CONSULTA:
-{query}
-
-RESPUESTA:
-{respuesta_llm['respuesta']}
-
-CRITERIOS DE EVALUACIÓN:
-1. Relevancia: ¿Responde directamente a la consulta?
-2. Precisión: ¿Es técnicamente correcta?
-3. Completitud: ¿Cubre los aspectos importantes?
-4. Claridad: ¿Es fácil de entender?
-5. Fundamentación: ¿Está basada en la información proporcionada?
-
-Responde SOLO con el número del 1 al 10:"""
-        
-        return prompt
+        """Crea el mensaje de usuario para evaluación de calidad (criterios en QUALITY_SYSTEM_PROMPT)"""
+        return f"CONSULTA:\n{query}\n\nRESPUESTA:\n{respuesta_llm['respuesta']}"
     
-    def procesar_consulta_completa(self, query: str) -> Dict[str, Any]:
+    async def procesar_consulta_completa_async(self, query: str, query_embedding: List[float] = None,
+                                               on_token: Optional[Callable[[str], None]] = None,
+                                               on_evaluacion: Optional[Callable[[str], None]] = None,
+                                               chunks_relevantes: Optional[List[Dict]] = None) -> Dict[str, Any]:
         """
         Ejecuta el pipeline completo: RAG → LLM → Quality Agent
         
         Args:
             query: Consulta del usuario
+            query_embedding: Embedding ya calculado de la consulta (opcional)
+            on_token: Si se indica, la respuesta del LLM se genera en streaming y
+                cada fragmento se le entrega según llega (opcional)
+            on_evaluacion: Si se indica, recibe la puntuación de calidad cuando la
+                evaluación en segundo plano termina (opcional)
+            chunks_relevantes: Chunks ya recuperados; si se indican se omite el PASO 1 (opcional)
             
         Returns:
             Diccionario con todos los resultados del pipeline
@@ -326,14 +604,30 @@ Responde SOLO con el número del 1 al 10:"""
         
         self.logger.info("CUPRA RAG PIPELINE INICIADO")
         
-        # Paso 1: RAG - Recuperación
-        chunks_relevantes = self.paso_1_rag(query, top_k=4)
+        # Paso 1: RAG - Recuperación (psycopg2 es bloqueante, va a un hilo)
+        if chunks_relevantes is None:
+            if query_embedding is None:
+                query_embedding = await self.embed_async(query) or None
+            chunks_relevantes = await asyncio.to_thread(
+                self.paso_1_rag, query, 4, query_embedding
+            )
         
         # Paso 2: LLM - Generación
-        respuesta_llm = self.paso_2_llm(query, chunks_relevantes)
+        if on_token is not None:
+            respuesta_llm = await self.paso_2_llm_con_tokens(query, chunks_relevantes, on_token)
+        else:
+            respuesta_llm = await self.paso_2_llm(query, chunks_relevantes)
         
-        # Paso 3: Quality Agent - Evaluación
-        evaluacion_calidad = self.paso_3_quality_agent(query, respuesta_llm)
+        timestamp = self._get_timestamp()
+        request_id = uuid.uuid4().hex
+        
+        # Paso 3: Quality Agent - Evaluación (en segundo plano si está activado)
+        if QUALITY_AGENT_ASYNC:
+            self._evaluar_en_segundo_plano(request_id, query, respuesta_llm, on_evaluacion)
+            evaluacion_calidad = ""
+        else:
+            evaluacion_calidad = await self.paso_3_quality_agent(query, respuesta_llm)
+            self._guardar_evaluacion(request_id, evaluacion_calidad)
         
         # Resultado final
         resultado_final = {
@@ -341,7 +635,8 @@ Responde SOLO con el número del 1 al 10:"""
             'chunks_recuperados': chunks_relevantes,
             'respuesta_llm': respuesta_llm,
             'evaluacion_calidad': evaluacion_calidad,
-            'timestamp': self._get_timestamp(),
+            'timestamp': timestamp,
+            'request_id': request_id,
             'fuente': 'PostgreSQL'
         }
         
@@ -350,6 +645,140 @@ Responde SOLO con el número del 1 al 10:"""
         
         return resultado_final
     
+    def _evaluar_en_segundo_plano(self, request_id: str, query: str, respuesta_llm: Dict[str, Any],
+                                  on_evaluacion: Optional[Callable[[str], None]] = None):
+        """
+        Lanza el Quality Agent como tarea en segundo plano y guarda su puntuación
+        
+        Args:
+            request_id: Identificador de la respuesta (clave de la evaluación)
+            query: Consulta original
+            respuesta_llm: Respuesta del LLM a evaluar
+            on_evaluacion: Función que recibe la puntuación al terminar (opcional)
+        """
+        async def evaluar():
+            evaluacion = await self.paso_3_quality_agent(query, respuesta_llm)
+            self._guardar_evaluacion(request_id, evaluacion)
+            self.logger.info(f"🏆 Evaluación de calidad ({request_id}): {evaluacion}/10")
+            if on_evaluacion is not None:
+                on_evaluacion(evaluacion)
+        
+        # Se guarda la referencia para que el recolector no cancele la tarea
+        tarea = asyncio.create_task(evaluar())
+        self._tareas_calidad.add(tarea)
+        tarea.add_done_callback(self._tareas_calidad.discard)
+    
+    def _guardar_evaluacion(self, request_id: str, evaluacion: str):
+        """Guarda una evaluación descartando las más antiguas por encima de EVALUACIONES_MAX"""
+        self._evaluaciones[request_id] = evaluacion
+        while len(self._evaluaciones) > EVALUACIONES_MAX:
+            self._evaluaciones.popitem(last=False)
+    
+    def obtener_evaluacion(self, request_id: str) -> Optional[str]:
+        """
+        Devuelve la evaluación de calidad de una respuesta
+        
+        Las evaluaciones viven en la memoria del worker que generó la respuesta.
+        
+        Args:
+            request_id: Identificador devuelto con la respuesta
+            
+        Returns:
+            Puntuación de calidad o None si aún no está disponible
+        """
+        return self._evaluaciones.get(request_id)
+    
+    async def procesar_consultas_batch(self, queries: List[str], max_concurrency: int = 10) -> List[Dict[str, Any]]:
+        """
+        Procesa varias consultas en paralelo con un único embedding y una única
+        búsqueda vectorial en lote
+        
+        Args:
+            queries: Lista de consultas
+            max_concurrency: Máximo de consultas en vuelo a la vez
+            
+        Returns:
+            Resultados del pipeline en el mismo orden que las consultas
+        """
+        embeddings = await self.embed_batch(queries)
+        chunks_por_consulta = await asyncio.to_thread(self.paso_1_rag_batch, queries, 4, embeddings)
+        semaforo = asyncio.Semaphore(max_concurrency)
+        
+        async def procesar(query: str, embedding: List[float], chunks: List[Dict]) -> Dict[str, Any]:
+            async with semaforo:
+                return await self.procesar_consulta_completa_async(
+                    query, embedding or None, chunks_relevantes=chunks
+                )
+        
+        return await asyncio.gather(*(
+            procesar(q, e, c) for q, e, c in zip(queries, embeddings, chunks_por_consulta)
+        ))
+    
+    async def procesar_consulta_stream(self, query: str, query_embedding: List[float] = None) -> AsyncIterator[str]:
+        """
+        Ejecuta el pipeline completo emitiendo eventos Server-Sent Events
+        
+        Emite `meta` con los datos de recuperación, `token` por cada fragmento
+        de la respuesta del LLM y `done` con la evaluación de calidad.
+        
+        Args:
+            query: Consulta del usuario
+            query_embedding: Embedding ya calculado de la consulta (opcional)
+            
+        Yields:
+            Eventos SSE ya formateados
+        """
+        self.logger.info("CUPRA RAG PIPELINE (STREAM) INICIADO")
+        
+        # Paso 1: RAG - Recuperación
+        if query_embedding is None:
+            query_embedding = await self.embed_async(query) or None
+        chunks_relevantes = await asyncio.to_thread(
+            self.paso_1_rag, query, 4, query_embedding
+        )
+        
+        # Paso 2: LLM - Generación en streaming
+        if not chunks_relevantes:
+            respuesta_llm = self._resultado_sin_contexto()
+            yield self._evento_sse('meta', {
+                'chunks_recuperados': 0,
+                'confianza': respuesta_llm['confianza'],
+                'fuentes': respuesta_llm['fuentes']
+            })
+            yield self._evento_sse('token', {'texto': respuesta_llm['respuesta']})
+        else:
+            contexto = self._construir_contexto(chunks_relevantes)
+            respuesta_llm = self._resultado_llm("", contexto, chunks_relevantes)
+            yield self._evento_sse('meta', {
+                'chunks_recuperados': len(chunks_relevantes),
+                'confianza': respuesta_llm['confianza'],
+                'fuentes': respuesta_llm['fuentes']
+            })
+            
+            partes = []
+            try:
+                async for texto in self.paso_2_llm_stream(query, chunks_relevantes, contexto):
+                    partes.append(texto)
+                    yield self._evento_sse('token', {'texto': texto})
+            except Exception as e:
+                self.logger.warning(f"❌ Error en PASO 2 - LLM (stream): {e}")
+                yield self._evento_sse('error', {'detail': f"Error generando respuesta: {str(e)}"})
+                return
+            respuesta_llm['respuesta'] = "".join(partes)
+        
+        # Paso 3: Quality Agent - Evaluación
+        evaluacion_calidad = await self.paso_3_quality_agent(query, respuesta_llm)
+        
+        yield self._evento_sse('done', {
+            'evaluacion_calidad': evaluacion_calidad,
+            'timestamp': self._get_timestamp(),
+            'fuente': 'PostgreSQL'
+        })
+    
+    def _evento_sse(self, evento: str, datos: Dict[str, Any]) -> str:
+        """Formatea un evento Server-Sent Events"""
+        return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+    
     def _get_timestamp(self) -> str:
         """Obtiene timestamp actual"""
         from datetime import datetime
@@ -372,7 +801,12 @@ Responde SOLO con el número del 1 al 10:"""
         print(resultado['respuesta_llm']['respuesta'])
         print(f"{'─'*40}")
 
-def main():
+def _escribir_token(texto: str):
+    """Escribe un fragmento de la respuesta en la terminal sin esperar al resto"""
+    sys.stdout.write(texto)
+    sys.stdout.flush()
+
+async def main_async():
     """Función principal para probar el pipeline"""
     try:
         # Verificar configuración
@@ -381,7 +815,8 @@ def main():
             return
         
         # Inicializar pipeline
-        pipeline = CupraRAGPipeline()
+        pipeline = CupraRAGPipeline(logger=logging.getLogger(__name__))
+        await asyncio.to_thread(cargar_tokenizador)
         
         print("🚀 CUPRA RAG Pipeline iniciado")
         print("💡 Ejemplos de consultas:")
@@ -392,7 +827,7 @@ def main():
         
         while True:
             # Obtener consulta del usuario
-            query = input("\n🔍 Ingresa tu consulta (o 'salir' para terminar): ").strip()
+            query = (await asyncio.to_thread(input, "\n🔍 Ingresa tu consulta (o 'salir' para terminar): ")).strip()
             
             if query.lower() in ['salir', 'exit', 'quit', 'q']:
                 print("👋 ¡Hasta luego!")
@@ -402,17 +837,34 @@ def main():
                 print("⚠️ Por favor ingresa una consulta válida")
                 continue
             
-            # Procesar consulta completa
-            resultado = pipeline.procesar_consulta_completa(query)
+            # Procesar consulta completa mostrando la respuesta según se genera
+            print("\n🤖 ", end="", flush=True)
+            evaluada = asyncio.get_running_loop().create_future()
+            resultado = await pipeline.procesar_consulta_completa_async(
+                query, on_token=_escribir_token, on_evaluacion=evaluada.set_result
+            )
+            print()
+            
+            # Con QUALITY_AGENT_ASYNC la evaluación llega después: se espera para
+            # guardarla (asyncio.run cancelaría la tarea al salir)
+            if QUALITY_AGENT_ASYNC:
+                resultado['evaluacion_calidad'] = await evaluada
+            print(f"🏆 Puntuación calidad: {resultado['evaluacion_calidad']}/10")
             
-            # Opcional: Guardar resultado
-            with open("resultado_cupra.json", 'w', encoding='utf-8') as f:
-                json.dump(resultado, f, ensure_ascii=False, indent=2)
+            # Opcional: Guardar resultado (una línea JSON por consulta)
+            with open("resultado_cupra.jsonl", 'ab') as f:
+                f.write(orjson.dumps(resultado, default=str, option=orjson.OPT_APPEND_NEWLINE))
             
     except KeyboardInterrupt:
         print("\n👋 ¡Proceso cancelado!")
     except Exception as e:
         print(f"❌ Error en el proceso principal: {e}")
+    finally:
+        await get_retriever().cerrar_async()
+
+def main():
+    """Ejecuta el pipeline interactivo en un único event loop"""
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,14 +1,31 @@
 import os
+import asyncio
+import hashlib
+import threading
+import numpy as np
+import orjson
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from psycopg2 import errors as pg_errors
+from psycopg2.pool import ThreadedConnectionPool
 # from openai import OpenAI
 from typing import List, Dict, Any
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from services.config import vector_config
 
 try:
-    from openai import OpenAI  # opcional: solo si generas embeddings aquí
-except Exception:
-    OpenAI = None  # evita romper el arranque si no está instalado
+    import httpx
+    from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient  # opcional: solo si generas embeddings aquí
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    # 429, 5xx y fallos de red/timeout: merecen reintento
+    ERRORES_TRANSITORIOS_OPENAI = (RateLimitError, APIConnectionError, InternalServerError)
+except ImportError:
+    # Solo si el paquete no está instalado; un nombre mal importado debe fallar al arrancar
+    OpenAI = AsyncOpenAI = None
+    ERRORES_TRANSITORIOS_OPENAI = ()
 
 load_dotenv()
 
@@ -23,9 +40,196 @@ SSLMODE = os.getenv('SSLMODE', "require")
 # Configuración OpenAI
 OPENAI_API_KEY = os.getenv('KEY_OPENAI')
 EMBEDDING_MODEL = os.getenv('MODEL', 'text-embedding-ada-002')
+EMBEDDINGS_CACHE_SIZE = 1024
+# Segundos que una consulta espera por una conexión libre del pool
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+# Llamadas a OpenAI simultáneas por proceso (protege los límites RPM/TPM)
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', 10))
 
-# Configurar cliente OpenAI
-_openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Cliente OpenAI único para todo el proceso (embeddings y chat): reutiliza
+# las conexiones keep-alive y evita un handshake TLS por petición.
+# Se crea en el primer uso, no al importar el módulo.
+@lru_cache(maxsize=1)
+def get_openai_client():
+    """Cliente OpenAI compartido (None si el paquete no está instalado)"""
+    if OpenAI is None:
+        return None
+    return OpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0,  # los reintentos los gestiona reintentar_openai
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        )
+    )
+
+# Cliente asíncrono para el pipeline servido desde FastAPI
+@lru_cache(maxsize=1)
+def get_async_openai_client():
+    """Cliente AsyncOpenAI compartido (None si el paquete no está instalado)"""
+    if AsyncOpenAI is None:
+        return None
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0,  # los reintentos los gestiona reintentar_openai
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        )
+    )
+
+# Reintento con backoff exponencial y jitter ante errores transitorios; el resto
+# de errores (y el último intento) se propagan a quien llama
+reintentar_openai = retry(
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(ERRORES_TRANSITORIOS_OPENAI),
+    reraise=True,
+)
+
+# Semáforo global de llamadas asíncronas; se libera durante la espera entre reintentos
+_openai_sem = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+@reintentar_openai
+def crear_embeddings(**kwargs):
+    """embeddings.create con reintentos (cliente síncrono)"""
+    return get_openai_client().embeddings.create(**kwargs)
+
+@reintentar_openai
+async def crear_embeddings_async(**kwargs):
+    """embeddings.create con reintentos y límite de concurrencia"""
+    async with _openai_sem:
+        return await get_async_openai_client().embeddings.create(**kwargs)
+
+@reintentar_openai
+async def crear_chat_async(**kwargs):
+    """
+    chat.completions.create con reintentos y límite de concurrencia
+    
+    Con stream=True solo se limita la apertura del stream, no su lectura.
+    """
+    async with _openai_sem:
+        return await get_async_openai_client().chat.completions.create(**kwargs)
+
+# Sentencias preparadas una vez por conexión (ver PoolCupra): las búsquedas
+# solo hacen EXECUTE y Postgres se ahorra el parseo y la planificación.
+# La columna embedding es halfvec (ver cupra_migrations.py).
+SQL_PREPARAR_BUSQUEDA = """
+PREPARE cupra_search (halfvec, int) AS
+SELECT 
+    id,
+    COALESCE(title, 'Sin título') as titulo,
+    COALESCE(contenido, '') as cont,
+    1 - dist as similitud,
+    COALESCE(subchunk, 0) as subchunk,
+    COALESCE(char_count, 0) as num,
+    created_at
+FROM (
+    -- La distancia se calcula una vez: ORDER BY dist sigue usando el índice HNSW
+    SELECT id, title, contenido, subchunk, char_count, created_at, embedding <=> $1 as dist
+    FROM cupra_chunks
+    ORDER BY dist
+    LIMIT $2
+) top
+ORDER BY dist;
+"""
+
+_SQL_TITULO = """
+SELECT 
+    id,
+    COALESCE(title, 'Sin título') as titulo,
+    COALESCE(contenido, '') as cont,
+    COALESCE(char_count, 0) as num,
+    COALESCE(subchunk, 0) as subchunk,
+    created_at
+FROM cupra_chunks
+WHERE title ILIKE $1
+{filtro_keyset}
+ORDER BY COALESCE(char_count, 0) DESC, id DESC
+LIMIT $2
+"""
+# Claves de los chunks, en el orden de las columnas de cada SELECT: las filas
+# llegan como tuplas y se convierten con dict(zip(...)) sin más trabajo por campo
+COLUMNAS_BUSQUEDA = ('chunk_id', 'titulo', 'cont', 'similitud', 'subchunk', 'num', 'created_at')
+COLUMNAS_TITULO = ('chunk_id', 'titulo', 'cont', 'num', 'subchunk', 'created_at')
+COLUMNAS_ESTADISTICAS = ('total_chunks', 'titulos_unicos', 'promedio_caracteres', 'ultimo_ingreso')
+
+SQL_PREPARAR_TITULO = "PREPARE cupra_titulo (text, int) AS " + _SQL_TITULO.format(filtro_keyset="") + ";"
+# $4 (id) sin tipo declarado: Postgres lo infiere de la columna
+SQL_PREPARAR_TITULO_KEYSET = "PREPARE cupra_titulo_keyset (text, int, int) AS " + _SQL_TITULO.format(
+    filtro_keyset="AND (COALESCE(char_count, 0), id) < ($3, $4)"
+) + ";"
+
+SENTENCIAS_PREPARADAS = {
+    'cupra_search': SQL_PREPARAR_BUSQUEDA,
+    'cupra_titulo': SQL_PREPARAR_TITULO,
+    'cupra_titulo_keyset': SQL_PREPARAR_TITULO_KEYSET,
+}
+
+class PoolCupra(ThreadedConnectionPool):
+    """
+    Pool que prepara las sentencias de búsqueda en cada conexión
+    
+    Cada sentencia se prepara por separado al abrir la conexión; las que
+    fallen (p. ej. cupra_search con el esquema aún sin migrar a halfvec) se
+    vuelven a intentar la primera vez que se usan en esa conexión.
+    """
+    
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        # id(conexión) -> nombres ya preparados; antes de super() porque este
+        # ya abre las minconn conexiones iniciales
+        self._preparadas: Dict[int, set] = {}
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # _putconn cierra las conexiones devueltas en cuanto hay minconn libres, y
+        # cada ráfaga volvería a pagar conexión + PREPAREs. Tras abrir las
+        # iniciales, minconn = maxconn conserva abiertas todas las que se abran
+        self.minconn = maxconn
+    
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        self._preparadas[id(conn)] = set()
+        for nombre in SENTENCIAS_PREPARADAS:
+            try:
+                self._preparar(conn, nombre)
+                # PREPARE no es transaccional; se cierra la transacción implícita
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"⚠️ No se pudo preparar {nombre}: {e}")
+        return conn
+    
+    def _preparar(self, conn, nombre: str):
+        with conn.cursor() as cur:
+            cur.execute(SENTENCIAS_PREPARADAS[nombre])
+        self._preparadas[id(conn)].add(nombre)
+    
+    def ejecutar_preparada(self, conn, cur, nombre: str, params: tuple, previas: tuple = ()):
+        """
+        Ejecuta EXECUTE nombre(params), preparándola antes si hace falta
+        
+        Si el servidor ya no la conoce (DEALLOCATE, reconexión de un proxy) se
+        deshace la transacción, se vuelve a preparar y se repite una vez.
+        
+        Args:
+            conn: Conexión del pool
+            cur: Cursor de esa conexión
+            nombre: Nombre de la sentencia (clave de SENTENCIAS_PREPARADAS)
+            params: Parámetros del EXECUTE
+            previas: Pares (sql, params) a ejecutar antes en la misma transacción
+        """
+        execute_sql = f"EXECUTE {nombre} ({', '.join(['%s'] * len(params))});"
+        for intento in range(2):
+            preparadas = self._preparadas.setdefault(id(conn), set())
+            if nombre not in preparadas:
+                self._preparar(conn, nombre)
+            try:
+                for sql, sql_params in previas:
+                    cur.execute(sql, sql_params)
+                cur.execute(execute_sql, params)
+                return
+            except pg_errors.InvalidSqlStatementName:
+                conn.rollback()
+                preparadas.discard(nombre)
+                if intento:
+                    raise
 
 class CupraRetrieval:
     """Clase para manejo de búsqueda y recuperación en base de datos CUPRA"""
@@ -40,27 +244,129 @@ class CupraRetrieval:
             'sslmode': SSLMODE,
             "connect_timeout": 5,
         }
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Plazas del pool: getconn lanza PoolError si está agotado en lugar de
+        # esperar, así que las peticiones hacen cola aquí antes de pedir conexión
+        self._pool_sem = None
+        
+        # Construcción del índice HNSW en segundo plano (una por proceso); si
+        # falla o se omite no se reintenta hasta reiniciar
+        self._indice_hilo = None
+        self._indice_fallido = False
+        self._indice_lock = threading.Lock()
+        
+        # Cache LRU de embeddings de consultas
+        self._embeddings_cache = OrderedDict()
+        self._embeddings_lock = threading.Lock()
         # self._test_connection()
     
     def _test_connection(self):
         """Prueba la conexión a la base de datos"""
         try:
-            conn = self._get_connection()
-            conn.close()
+            with self._get_connection():
+                pass
             # print("✅ Conexión a PostgreSQL exitosa")
         except Exception as e:
             print(f"❌ Error conectando a PostgreSQL: {e}")
             raise
     
+    def iniciar_pool(self, minconn: int = 2, maxconn: int = 10) -> PoolCupra:
+        """
+        Crea (si no existe) el pool de conexiones compartido por todas las consultas
+        
+        Args:
+            minconn: Conexiones abiertas desde el inicio
+            maxconn: Máximo de conexiones simultáneas (las abiertas no se cierran al devolverlas)
+            
+        Returns:
+            El pool de conexiones
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = PoolCupra(minconn, maxconn, **self.connection_params)
+                self._pool_sem = threading.BoundedSemaphore(maxconn)
+            return self._pool
+    
+    def cerrar_pool(self):
+        """Cierra todas las conexiones del pool"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._pool_sem = None
+    
+    def cerrar(self):
+        """Cierra el pool de conexiones y el cliente HTTP de OpenAI"""
+        self.cerrar_pool()
+        # Solo se cierra el cliente si llegó a crearse
+        if get_openai_client.cache_info().currsize:
+            cliente = get_openai_client()
+            if cliente is not None:
+                cliente.close()
+            get_openai_client.cache_clear()
+    
+    async def cerrar_async(self):
+        """Cierra además el cliente AsyncOpenAI (desde el event loop que lo usa)"""
+        self.cerrar()
+        if get_async_openai_client.cache_info().currsize:
+            cliente = get_async_openai_client()
+            if cliente is not None:
+                await cliente.close()
+            get_async_openai_client.cache_clear()
+    
+    @contextmanager
     def _get_connection(self):
-        """Obtiene una nueva conexión a la base de datos"""
-        return psycopg2.connect(**self.connection_params)
+        """
+        Toma una conexión del pool (creándolo si hace falta) y la devuelve al salir
+        
+        Si todas las conexiones están en uso espera hasta POOL_TIMEOUT segundos
+        a que se libere una.
+        """
+        with self._pool_lock:
+            pool, semaforo = self._pool, self._pool_sem
+        if pool is None:
+            pool = self.iniciar_pool()
+            semaforo = self._pool_sem
+        if not semaforo.acquire(timeout=POOL_TIMEOUT):
+            raise TimeoutError(f"Sin conexiones libres en el pool tras {POOL_TIMEOUT:.0f}s")
+        try:
+            conn = pool.getconn()
+            try:
+                yield conn
+            finally:
+                # putconn hace rollback de la transacción pendiente; las
+                # conexiones rotas se cierran en lugar de volver al pool
+                pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            semaforo.release()
     
     # ---------- Embeddings ----------
+    def _clave_embedding(self, query: str) -> str:
+        """Clave del cache de embeddings: modelo + consulta normalizada"""
+        return hashlib.sha256(f"{EMBEDDING_MODEL}\0{query.strip().lower()}".encode("utf-8")).hexdigest()
+    
+    def _embedding_cacheado(self, clave: str):
+        with self._embeddings_lock:
+            embedding = self._embeddings_cache.get(clave)
+            if embedding is not None:
+                self._embeddings_cache.move_to_end(clave)
+            return embedding
+    
+    def _cachear_embedding(self, clave: str, embedding: List[float]):
+        with self._embeddings_lock:
+            self._embeddings_cache[clave] = tuple(embedding)
+            self._embeddings_cache.move_to_end(clave)
+            while len(self._embeddings_cache) > EMBEDDINGS_CACHE_SIZE:
+                self._embeddings_cache.popitem(last=False)
+    
     def generar_embedding_query(self, query: str, logger=None) -> List[float]:
         """
         Genera embedding para la consulta del usuario
         
+        Las consultas repetidas (mismo texto sin distinguir mayúsculas) se
+        sirven desde un cache LRU sin llamar a OpenAI.
+        
         Args:
             query: Texto de la consulta
             
@@ -69,84 +375,172 @@ class CupraRetrieval:
         """
         if not query or not query.strip():
             return []
-        if _openai_client is None:
+        
+        clave = self._clave_embedding(query)
+        embedding = self._embedding_cacheado(clave)
+        if embedding is not None:
+            return list(embedding)
+        
+        openai_client = get_openai_client()
+        if openai_client is None:
             if logger: logger.error("OpenAI API key ausente o cliente no disponible")
             return []
         
         try:
-            respuesta = _openai_client.embeddings.create(
+            respuesta = crear_embeddings(
                 model=EMBEDDING_MODEL,
                 input=query.strip()
             )
-            return respuesta.data[0].embedding
+            embedding = respuesta.data[0].embedding
+            self._cachear_embedding(clave, embedding)
+            return embedding
             
         except Exception as e:
             # print(f"❌ Error generando embedding para la query: {e}")
-            logger.warning(f"❌ Error generando embedding para la query: {e}")
+            if logger: logger.warning(f"❌ Error generando embedding para la query: {e}")
             return []
     
+    def _separar_cacheados(self, queries: List[str]):
+        """
+        Resuelve desde el cache lo que se pueda de un lote de consultas
+        
+        Returns:
+            (embeddings, pendientes): embeddings en orden (vacíos los que faltan) y
+            un dict clave -> (texto, posiciones) con las consultas a pedir a OpenAI
+        """
+        embeddings = [[] for _ in queries]
+        pendientes = {}
+        for i, q in enumerate(queries):
+            if not q or not q.strip():
+                continue
+            clave = self._clave_embedding(q)
+            embedding = self._embedding_cacheado(clave)
+            if embedding is not None:
+                embeddings[i] = list(embedding)
+            else:
+                pendientes.setdefault(clave, (q.strip(), []))[1].append(i)
+        return embeddings, pendientes
+    
+    def _completar_embeddings(self, embeddings: List[List[float]], pendientes: Dict, datos) -> List[List[float]]:
+        """Reparte la respuesta de OpenAI en sus posiciones y la guarda en el cache"""
+        for (clave, (_, posiciones)), dato in zip(pendientes.items(), datos):
+            self._cachear_embedding(clave, dato.embedding)
+            for i in posiciones:
+                embeddings[i] = dato.embedding
+        return embeddings
+    
+    def generar_embeddings_queries(self, queries: List[str], logger=None) -> List[List[float]]:
+        """
+        Genera los embeddings de varias consultas en una única llamada a OpenAI
+        
+        Solo se piden a OpenAI las consultas que no estén en el cache (una vez
+        cada una aunque se repitan en el lote).
+        
+        Args:
+            queries: Lista de textos de consulta
+            
+        Returns:
+            Lista de embeddings en el mismo orden (lista vacía para las consultas inválidas)
+        """
+        embeddings, pendientes = self._separar_cacheados(queries)
+        if not pendientes:
+            return embeddings
+        openai_client = get_openai_client()
+        if openai_client is None:
+            if logger: logger.error("OpenAI API key ausente o cliente no disponible")
+            return embeddings
+        
+        try:
+            respuesta = crear_embeddings(
+                model=EMBEDDING_MODEL,
+                input=[texto for texto, _ in pendientes.values()]
+            )
+            return self._completar_embeddings(embeddings, pendientes, respuesta.data)
+            
+        except Exception as e:
+            if logger: logger.warning(f"❌ Error generando embeddings en lote: {e}")
+            return embeddings
+    
+    async def generar_embeddings_queries_async(self, queries: List[str], logger=None) -> List[List[float]]:
+        """
+        Versión asíncrona de generar_embeddings_queries (cliente AsyncOpenAI)
+        
+        Args:
+            queries: Lista de textos de consulta
+            
+        Returns:
+            Lista de embeddings en el mismo orden (lista vacía para las consultas inválidas)
+        """
+        embeddings, pendientes = self._separar_cacheados(queries)
+        if not pendientes:
+            return embeddings
+        async_openai_client = get_async_openai_client()
+        if async_openai_client is None:
+            if logger: logger.error("OpenAI API key ausente o cliente no disponible")
+            return embeddings
+        
+        try:
+            respuesta = await crear_embeddings_async(
+                model=EMBEDDING_MODEL,
+                input=[texto for texto, _ in pendientes.values()]
+            )
+            return self._completar_embeddings(embeddings, pendientes, respuesta.data)
+            
+        except Exception as e:
+            if logger: logger.warning(f"❌ Error generando embeddings en lote: {e}")
+            return embeddings
+    
+    async def generar_embedding_query_async(self, query: str, logger=None) -> List[float]:
+        """
+        Versión asíncrona de generar_embedding_query (comparte el cache)
+        
+        Args:
+            query: Texto de la consulta
+            
+        Returns:
+            Lista de floats representando el embedding
+        """
+        return (await self.generar_embeddings_queries_async([query], logger=logger))[0]
+    
     # ---------- Búsqueda vectorial ----------
-    def buscar_chunks_similares(self, query: str, top_k: int = 4, logger = None) -> List[Dict]:
+    def buscar_chunks_similares(self, query: str, top_k: int = 4, logger = None, query_embedding: List[float] = None) -> List[Dict]:
         """
         Busca los chunks más similares usando búsqueda vectorial coseno
         
         Args:
             query: Consulta de texto del usuario
             top_k: Número de resultados a devolver (default: 4)
+            query_embedding: Embedding ya calculado de la consulta (opcional)
             
         Returns:
             Lista de chunks más similares con sus scores
         """
         try:
-            # Generar embedding de la consulta
-            logger.debug("Convirtiendo pregunta a embedding")
-            query_embedding = self.generar_embedding_query(query, logger=None)
+            # Generar embedding de la consulta si no viene calculado
+            if query_embedding is None:
+                logger.debug("Convirtiendo pregunta a embedding")
+                query_embedding = self.generar_embedding_query(query, logger=None)
             if not query_embedding:
                 # print("❌ No se pudo generar embedding para la consulta")
                 logger.warning("❌ No se pudo generar embedding para la consulta")
                 return []
             
             # Convertir embedding a formato pgvector
-            embedding_str = "[" + ",".join(str(x) for x in query_embedding) + "]"
-            
-            conn = self._get_connection()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            # Consulta SQL con búsqueda vectorial usando similitud coseno
-            # 1 - (embedding <=> query) da la similitud coseno (mayor = más similar)
-            query_sql = """
-            SELECT 
-                id,
-                title as titulo,
-                contenido as cont,
-                char_count as num,
-                subchunk,
-                1 - (embedding <=> %s::vector) as similitud,
-                created_at
-            FROM cupra_chunks
-            ORDER BY embedding <=> %s::vector
-            LIMIT %s;
-            """
-            
-            cur.execute(query_sql, (embedding_str, embedding_str, top_k))
-            resultados = cur.fetchall()
-            
-            # Convertir a lista de diccionarios
-            chunks_similares = []
-            for row in resultados:
-                chunk = {
-                    'chunk_id': row['id'],
-                    'titulo': row['titulo'] or 'Sin título',
-                    'cont': row['cont'] or '',
-                    'similitud': float(row['similitud']),
-                    'subchunk': row['subchunk'] or 0,
-                    'num': row['num'] or 0,
-                    'created_at': row['created_at']
-                }
-                chunks_similares.append(chunk)
-            
-            cur.close()
-            conn.close()
+            embedding_str = self._literal_vector(query_embedding)
+            
+            with self._get_connection() as conn, conn.cursor() as cur:
+                # Búsqueda vectorial por similitud coseno (sentencia cupra_search):
+                # 1 - (embedding <=> query) da la similitud coseno (mayor = más similar)
+                
+                # Ajustar la búsqueda HNSW solo para esta transacción
+                self._pool.ejecutar_preparada(
+                    conn, cur, 'cupra_search', (embedding_str, top_k),
+                    previas=(("SET LOCAL hnsw.ef_search = %s;", (vector_config.ef_search,)),)
+                )
+                resultados = cur.fetchall()
+                
+                # Convertir a lista de diccionarios
+                chunks_similares = [dict(zip(COLUMNAS_BUSQUEDA, row)) for row in resultados]
             
             # print(f"🔍 Encontrados {len(chunks_similares)} chunks similares")
             # for i, chunk in enumerate(chunks_similares, 1):
@@ -161,52 +555,114 @@ class CupraRetrieval:
             logger.error(f"❌ Error en búsqueda vectorial: {e}")
             return []
     
-    def buscar_por_titulo(self, titulo_busqueda: str, limit: int = 10) -> List[Dict]:
+    def buscar_chunks_similares_batch(self, queries: List[str], top_k: int = 4, logger = None, query_embeddings: List[List[float]] = None) -> List[List[Dict]]:
+        """
+        Busca los chunks más similares para varias consultas a la vez
+        
+        Los embeddings se generan en una única llamada a OpenAI y todas las
+        búsquedas van en una sola consulta SQL (una rama UNION ALL por consulta,
+        cada una con su ORDER BY/LIMIT para que use el índice HNSW).
+        
+        Args:
+            queries: Lista de consultas de texto
+            top_k: Número de resultados por consulta (default: 4)
+            query_embeddings: Embeddings ya calculados de las consultas (opcional)
+            
+        Returns:
+            Lista de listas de chunks, en el mismo orden que las consultas
+        """
+        resultados_por_consulta: List[List[Dict]] = [[] for _ in queries]
+        try:
+            if query_embeddings is None:
+                query_embeddings = self.generar_embeddings_queries(queries, logger=logger)
+            
+            rama_sql = """
+                (SELECT 
+                    %s as idx,
+                    id,
+                    COALESCE(title, 'Sin título') as titulo,
+                    COALESCE(contenido, '') as cont,
+                    1 - dist as similitud,
+                    COALESCE(subchunk, 0) as subchunk,
+                    COALESCE(char_count, 0) as num,
+                    created_at
+                FROM (
+                    SELECT id, title, contenido, subchunk, char_count, created_at,
+                        embedding <=> %s::halfvec as dist
+                    FROM cupra_chunks
+                    ORDER BY dist
+                    LIMIT %s
+                ) top)
+            """
+            ramas, params = [], []
+            for idx, embedding in enumerate(query_embeddings):
+                # Las consultas sin embedding se quedan sin resultados
+                if not embedding:
+                    continue
+                embedding_str = self._literal_vector(embedding)
+                ramas.append(rama_sql)
+                params.extend((idx, embedding_str, top_k))
+            
+            if not ramas:
+                return resultados_por_consulta
+            
+            with self._get_connection() as conn, conn.cursor() as cur:
+                cur.execute("SET LOCAL hnsw.ef_search = %s;", (vector_config.ef_search,))
+                cur.execute(" UNION ALL ".join(ramas) + ";", params)
+                for idx, *fila in cur.fetchall():
+                    resultados_por_consulta[idx].append(dict(zip(COLUMNAS_BUSQUEDA, fila)))
+            
+            # UNION ALL no garantiza el orden entre ramas: reordenar cada consulta
+            for chunks in resultados_por_consulta:
+                chunks.sort(key=lambda chunk: chunk['similitud'], reverse=True)
+            
+            return resultados_por_consulta
+            
+        except Exception as e:
+            if logger: logger.error(f"❌ Error en búsqueda vectorial por lotes: {e}")
+            return [[] for _ in queries]
+    
+    @staticmethod
+    def _literal_vector(embedding) -> str:
+        """
+        Serializa un embedding al literal de texto de pgvector ('[x,y,...]')
+        
+        orjson genera exactamente ese formato en C, sin el join de 1536
+        str(float) en Python. Con float32 orjson escribe la representación más
+        corta de cada valor en lugar de los ~17 dígitos del repr de float64, y
+        el literal ocupa en torno a un 40% menos; el redondeo a fp16 queda para
+        el ::halfvec del servidor.
+        """
+        return orjson.dumps(
+            np.asarray(embedding, dtype=np.float32), option=orjson.OPT_SERIALIZE_NUMPY
+        ).decode()
+    
+    def buscar_por_titulo(self, titulo_busqueda: str, limit: int = 10, despues_de: tuple = None) -> List[Dict]:
         """
         Busca chunks por título usando LIKE
         
+        Paginación por keyset: en lugar de OFFSET se continúa a partir de la
+        última fila devuelta, así el coste no crece con la profundidad de página.
+        
         Args:
             titulo_busqueda: Texto a buscar en títulos
             limit: Número máximo de resultados
+            despues_de: Tupla (num, chunk_id) de la última fila de la página anterior
             
         Returns:
             Lista de chunks que coinciden
         """
         try:
-            conn = self._get_connection()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            query = """
-            SELECT 
-                id,
-                title as titulo,
-                contenido as cont,
-                char_count as num,
-                subchunk,
-                created_at
-            FROM cupra_chunks
-            WHERE title ILIKE %s
-            ORDER BY char_count DESC
-            LIMIT %s;
-            """
-            
-            cur.execute(query, (f"%{titulo_busqueda}%", limit))
-            resultados = cur.fetchall()
-            
-            chunks = []
-            for row in resultados:
-                chunk = {
-                    'chunk_id': row['id'],
-                    'titulo': row['titulo'] or 'Sin título',
-                    'cont': row['cont'] or '',
-                    'num': row['num'] or 0,
-                    'subchunk': row['subchunk'] or 0,
-                    'created_at': row['created_at']
-                }
-                chunks.append(chunk)
-            
-            cur.close()
-            conn.close()
+            with self._get_connection() as conn, conn.cursor() as cur:
+                # Comodines del usuario como literales (ILIKE escapa con "\"), para que
+                # "%%%" o "___" no coincidan con toda la tabla
+                literal = titulo_busqueda.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                patron = f"%{literal}%"
+                if despues_de:
+                    self._pool.ejecutar_preparada(conn, cur, 'cupra_titulo_keyset', (patron, limit, *despues_de))
+                else:
+                    self._pool.ejecutar_preparada(conn, cur, 'cupra_titulo', (patron, limit))
+                chunks = [dict(zip(COLUMNAS_TITULO, row)) for row in cur.fetchall()]
             
             print(f"📚 Encontrados {len(chunks)} chunks por título")
             return chunks
@@ -215,28 +671,34 @@ class CupraRetrieval:
             print(f"❌ Error en búsqueda por título: {e}")
             return []
     
-    def obtener_estadisticas_bd(self, logger = None) -> Dict[str, Any]:
-        """Obtiene estadísticas de la base de datos"""
+    def estimar_total_chunks(self) -> int:
+        """Estimación rápida del número de filas de cupra_chunks según el catálogo"""
         try:
-            conn = self._get_connection()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            # Consultas de estadísticas
-            queries = {
-                'total_chunks': "SELECT COUNT(*) as count FROM cupra_chunks;",
-                'titulos_unicos': "SELECT COUNT(DISTINCT title) as count FROM cupra_chunks;",
-                'promedio_caracteres': "SELECT AVG(char_count) as avg_chars FROM cupra_chunks;",
-                'ultimo_ingreso': "SELECT MAX(created_at) as last_insert FROM cupra_chunks;"
-            }
-            
-            stats = {}
-            for key, query in queries.items():
-                cur.execute(query)
+            with self._get_connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT reltuples FROM pg_class WHERE relname = 'cupra_chunks';")
                 result = cur.fetchone()
-                stats[key] = result[list(result.keys())[0]]
             
-            cur.close()
-            conn.close()
+            # reltuples vale -1 si la tabla no se ha analizado nunca
+            return max(int(result[0]), 0) if result else 0
+            
+        except Exception as e:
+            print(f"❌ Error estimando tamaño de cupra_chunks: {e}")
+            return 0
+    
+    def obtener_estadisticas_bd(self, logger = None) -> Dict[str, Any]:
+        """Obtiene estadísticas de la base de datos"""
+        try:
+            with self._get_connection() as conn, conn.cursor() as cur:
+                # Todas las estadísticas en un único viaje a la base de datos
+                cur.execute("""
+                    SELECT
+                        COUNT(*) AS total_chunks,
+                        COUNT(DISTINCT title) AS titulos_unicos,
+                        AVG(char_count) AS promedio_caracteres,
+                        MAX(created_at) AS ultimo_ingreso
+                    FROM cupra_chunks;
+                """)
+                stats = dict(zip(COLUMNAS_ESTADISTICAS, cur.fetchone()))
             
             return stats
             
@@ -245,40 +707,127 @@ class CupraRetrieval:
             logger.warning(f"Error obteniendo estadísticas: {e}")
             return {}
     
+    def _crear_indice_hnsw(self):
+        """
+        Crea el índice HNSW (halfvec_cosine_ops) sobre cupra_chunks.embedding
+        
+        CREATE INDEX CONCURRENTLY no bloquea escrituras pero puede tardar minutos
+        en tablas grandes, así que usa una conexión propia en autocommit fuera del pool.
+        Si no llega a crearlo marca _indice_fallido.
+        """
+        # Import diferido: cupra_migrations importa este módulo
+        from services.llm.cupra_migrations import (
+            INDICE_HNSW, SQL_TIPO_EMBEDDING, SQL_CREAR_INDICE_HNSW_CONCURRENTE,
+            SQL_INDICE_HNSW_ABANDONADO, SQL_ELIMINAR_INDICE_HNSW_CONCURRENTE, SQL_INDICE_HNSW_VALIDO
+        )
+        
+        creado = False
+        conn = None
+        try:
+            conn = psycopg2.connect(**self.connection_params)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                # halfvec_cosine_ops no sirve para una columna vector sin migrar
+                cur.execute(SQL_TIPO_EMBEDDING)
+                tipo_actual = cur.fetchone()[0]
+                if not tipo_actual.startswith("halfvec"):
+                    print(f"⚠️ Índice {INDICE_HNSW} no creado: embedding es {tipo_actual}, "
+                          f"ejecuta services/llm/cupra_migrations.py")
+                    return
+                
+                # Restos de una construcción interrumpida (p. ej. reinicio del proceso)
+                cur.execute(SQL_INDICE_HNSW_ABANDONADO)
+                if cur.fetchone()[0]:
+                    print(f"🗑️ Eliminando índice inválido {INDICE_HNSW}")
+                    cur.execute(SQL_ELIMINAR_INDICE_HNSW_CONCURRENTE)
+                
+                print(f"🏗️ Índice vectorial no encontrado, creando {INDICE_HNSW} en segundo plano...")
+                try:
+                    cur.execute(SQL_CREAR_INDICE_HNSW_CONCURRENTE)
+                except Exception as e:
+                    print(f"❌ Error creando índice {INDICE_HNSW}: {e}")
+                    # Sin esto el índice inválido impide reintentar (IF NOT EXISTS lo da por creado)
+                    cur.execute(SQL_ELIMINAR_INDICE_HNSW_CONCURRENTE)
+                    return
+                
+                cur.execute(SQL_INDICE_HNSW_VALIDO)
+                creado = cur.fetchone()[0]
+                if creado:
+                    print(f"✅ Índice {INDICE_HNSW} creado")
+                else:
+                    # IF NOT EXISTS lo omitió: ya existe, en construcción en otra sesión o inválido
+                    print(f"⚠️ Creación de {INDICE_HNSW} omitida: ya existe un índice con ese nombre sin terminar")
+        except Exception as e:
+            print(f"❌ Error en la construcción del índice {INDICE_HNSW}: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+            if not creado:
+                self._indice_fallido = True
+    
+    def _indice_en_construccion(self) -> bool:
+        """True mientras el hilo de construcción de este proceso sigue vivo"""
+        return self._indice_hilo is not None and self._indice_hilo.is_alive()
+    
+    def _lanzar_indice_hnsw(self) -> bool:
+        """
+        Lanza la construcción del índice HNSW en un hilo si no hay otra en curso
+        
+        Returns:
+            True si queda una construcción en curso en este proceso
+        """
+        with self._indice_lock:
+            if self._indice_fallido:
+                return False
+            if not self._indice_en_construccion():
+                self._indice_hilo = threading.Thread(
+                    target=self._crear_indice_hnsw, name="cupra-indice-hnsw", daemon=True
+                )
+                self._indice_hilo.start()
+            return True
+    
     def verificar_salud_bd(self) -> Dict[str, Any]:
         """Verifica el estado de salud de la base de datos"""
         try:
-            conn = self._get_connection()
-            cur = conn.cursor()
-            
-            # Verificar extensión pgvector
-            cur.execute("SELECT extname FROM pg_extension WHERE extname = 'vector';")
-            pgvector_exists = cur.fetchone() is not None
-            
-            # Verificar tabla existe
-            cur.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = 'cupra_chunks'
-                );
-            """)
-            table_exists = cur.fetchone()[0]
-            
-            # Verificar índice vectorial
-            cur.execute("""
-                SELECT indexname FROM pg_indexes 
-                WHERE tablename = 'cupra_chunks' 
-                AND indexname LIKE '%embedding%';
-            """)
-            vector_index_exists = cur.fetchone() is not None
-            
-            cur.close()
-            conn.close()
+            with self._get_connection() as conn, conn.cursor() as cur:
+                # Extensión pgvector, tabla e índice vectorial en un único viaje
+                cur.execute("""
+                    SELECT
+                        EXISTS (
+                            SELECT FROM pg_extension WHERE extname = 'vector'
+                        ),
+                        EXISTS (
+                            SELECT FROM information_schema.tables 
+                            WHERE table_name = 'cupra_chunks'
+                        ),
+                        EXISTS (
+                            SELECT FROM pg_indexes x
+                            JOIN pg_index i
+                            ON i.indexrelid = format('%I.%I', x.schemaname, x.indexname)::regclass
+                            WHERE x.tablename = 'cupra_chunks' 
+                            AND x.indexname LIKE '%embedding%'
+                            AND i.indisvalid
+                        ),
+                        EXISTS (
+                            SELECT FROM pg_stat_progress_create_index p
+                            JOIN pg_class c ON c.oid = p.relid
+                            WHERE c.relname = 'cupra_chunks'
+                        );
+                """)
+                pgvector_exists, table_exists, vector_index_exists, construccion_en_bd = cur.fetchone()
+            
+            # Crear el índice HNSW si falta (sin él cada búsqueda es un barrido secuencial).
+            # Se construye en segundo plano para no bloquear la sonda.
+            # Un índice a medio construir aún es inválido, y por eso cuenta como ausente.
+            indice_en_construccion = construccion_en_bd or self._indice_en_construccion()
+            if pgvector_exists and table_exists and not vector_index_exists and not indice_en_construccion:
+                indice_en_construccion = self._lanzar_indice_hnsw()
             
             return {
                 'pgvector_instalado': pgvector_exists,
                 'tabla_existe': table_exists,
                 'indice_vectorial': vector_index_exists,
+                'indice_en_construccion': indice_en_construccion,
                 'conexion_ok': True
             }
             
@@ -292,34 +841,29 @@ class CupraRetrieval:
                 'error': str(e)
             }
 
-# Instancia global del retriever
-# cupra_retriever = CupraRetrieval()
-try:
-    cupra_retriever = CupraRetrieval()
-except Exception as e:
-    print(f"[startup] retriever deshabilitado: {e}")
-    cupra_retriever = None
+# Instancia global del retriever, creada en el primer uso
+@lru_cache(maxsize=1)
+def get_retriever() -> CupraRetrieval:
+    """Retriever compartido por todo el proceso"""
+    return CupraRetrieval()
 
-def busqueda_cupra_chunks(query: str, top_k: int = 4, logger=None) -> List[Dict]:
+def busqueda_cupra_chunks(query: str, top_k: int = 4, logger=None, query_embedding: List[float] = None) -> List[Dict]:
     """
     Función principal para búsqueda de chunks usando PostgreSQL
     
     Args:
         query: Consulta de texto del usuario
         top_k: Número de resultados (default: 4 como en tu proyecto original)
+        query_embedding: Embedding ya calculado de la consulta (opcional)
         
     Returns:
         Lista de chunks relevantes
     """
     try:
-        
-        if cupra_retriever is None:
-            if logger: logger.error("DB no disponible (retriever=None)")
-            return []
         # print(f"🔍 Buscando información para: '{query}'")
         
         # Buscar chunks similares
-        resultados = cupra_retriever.buscar_chunks_similares(query, top_k, logger=logger)
+        resultados = get_retriever().buscar_chunks_similares(query, top_k, logger=logger, query_embedding=query_embedding)
         
         if resultados:
             # print(f"✅ Búsqueda exitosa: {len(resultados)} resultados")
@@ -334,6 +878,26 @@ def busqueda_cupra_chunks(query: str, top_k: int = 4, logger=None) -> List[Dict]
         print(f"❌ Error en búsqueda de chunks: {e}")
         return []
 
+def busqueda_cupra_chunks_batch(queries: List[str], top_k: int = 4, logger=None,
+                                query_embeddings: List[List[float]] = None) -> List[List[Dict]]:
+    """
+    Búsqueda de chunks para varias consultas con un único embedding y una única consulta SQL
+    
+    Args:
+        queries: Lista de consultas de texto
+        top_k: Número de resultados por consulta
+        query_embeddings: Embeddings ya calculados de las consultas (opcional)
+        
+    Returns:
+        Lista de listas de chunks, en el mismo orden que las consultas
+    """
+    resultados = get_retriever().buscar_chunks_similares_batch(
+        queries, top_k, logger=logger, query_embeddings=query_embeddings
+    )
+    if logger:
+        logger.info(f" Búsqueda por lotes: {sum(len(r) for r in resultados)} resultados para {len(queries)} consultas")
+    return resultados
+
 def mostrar_resultados_busqueda(query: str, resultados: List[Dict]):
     """
     Muestra los resultados de búsqueda de forma detallada
@@ -373,6 +937,7 @@ if __name__ == "__main__":
     print("="*50)
     
     # Verificar salud del sistema
+    cupra_retriever = get_retriever()
     salud = cupra_retriever.verificar_salud_bd()
     print("\n🔍 Estado del sistema:")
     for key, value in salud.items():
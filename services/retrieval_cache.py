@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class RetrievalCache:
+    """
+    Cache LRU de resultados de la búsqueda vectorial.
+
+    La clave es el embedding de la consulta cuantizado a int8 (pasos de 1/128),
+    de modo que embeddings prácticamente idénticos comparten entrada y se evita
+    el viaje a pgvector.
+    """
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, List[Dict]]" = OrderedDict()
+
+    @staticmethod
+    def _clave(query_embedding, top_k: int) -> tuple:
+        emb = np.asarray(query_embedding, dtype=np.float32)
+        cuantizado = np.clip(np.rint(emb * 128), -127, 127).astype(np.int8)
+        return (top_k, cuantizado.tobytes())
+
+    def get(self, query_embedding, top_k: int) -> Optional[List[Dict]]:
+        """
+        Devuelve los chunks cacheados para el embedding o None si no están
+
+        Args:
+            query_embedding: Embedding de la consulta
+            top_k: Número de chunks pedidos
+        """
+        clave = self._clave(query_embedding, top_k)
+        with self._lock:
+            chunks = self._entries.get(clave)
+            if chunks is None:
+                return None
+            self._entries.move_to_end(clave)
+            return chunks
+
+    def put(self, query_embedding, top_k: int, chunks: List[Dict]):
+        """
+        Guarda los chunks recuperados para el embedding
+
+        Args:
+            query_embedding: Embedding de la consulta
+            top_k: Número de chunks pedidos
+            chunks: Chunks devueltos por la búsqueda vectorial
+        """
+        clave = self._clave(query_embedding, top_k)
+        with self._lock:
+            self._entries[clave] = chunks
+            self._entries.move_to_end(clave)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Vacía el cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Instancia global del cache de recuperación
+retrieval_cache = RetrievalCache()
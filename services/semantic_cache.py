@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Cache semántico de respuestas indexado por el embedding de la consulta.
+
+    Guarda los embeddings normalizados en una matriz (N, dim) preasignada y
+    resuelve cada búsqueda con un único producto matricial. Al llenarse, la
+    entrada menos usada recientemente cede su fila a la nueva.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 10_000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None
+        self._size = 0
+        # fila de la matriz -> respuesta, en orden de uso (LRU primero)
+        self._responses: "OrderedDict[int, Any]" = OrderedDict()
+
+    @staticmethod
+    def _normalizar(query_embedding) -> Optional[np.ndarray]:
+        emb = np.asarray(query_embedding, dtype=np.float32)
+        if emb.ndim != 1:
+            return None
+        norma = np.linalg.norm(emb)
+        if norma == 0:
+            return None
+        return emb / norma
+
+    def lookup(self, query_embedding) -> Optional[Any]:
+        """
+        Busca una respuesta cacheada para una consulta semánticamente equivalente
+
+        Args:
+            query_embedding: Embedding de la consulta
+
+        Returns:
+            La respuesta cacheada o None si ninguna supera el umbral
+        """
+        emb = self._normalizar(query_embedding)
+        if emb is None:
+            return None
+
+        with self._lock:
+            if self._size == 0 or self._matrix.shape[1] != emb.shape[0]:
+                return None
+
+            similitudes = emb @ self._matrix[:self._size].T
+            fila = int(np.argmax(similitudes))
+            if similitudes[fila] < self.threshold:
+                return None
+
+            self._responses.move_to_end(fila)
+            return self._responses[fila]
+
+    def store(self, query_embedding, response: Any):
+        """
+        Guarda una respuesta asociada al embedding de la consulta
+
+        Args:
+            query_embedding: Embedding de la consulta
+            response: Respuesta a cachear
+        """
+        emb = self._normalizar(query_embedding)
+        if emb is None:
+            return
+
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != emb.shape[0]:
+                # Primer uso o cambio de modelo de embeddings: matriz nueva
+                self._matrix = np.zeros((self.max_entries, emb.shape[0]), dtype=np.float32)
+                self._size = 0
+                self._responses.clear()
+
+            if self._size < self.max_entries:
+                fila = self._size
+                self._size += 1
+            else:
+                fila, _ = self._responses.popitem(last=False)
+
+            self._matrix[fila] = emb
+            self._responses[fila] = response
+
+    def clear(self):
+        """Vacía el cache"""
+        with self._lock:
+            self._matrix = None
+            self._size = 0
+            self._responses.clear()
+
+    def __len__(self) -> int:
+        return self._size
+
+
+# Instancia global del cache semántico
+semantic_cache = SemanticCache()